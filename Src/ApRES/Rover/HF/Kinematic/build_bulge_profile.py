@@ -0,0 +1,60 @@
+# build_bulge_profile.py
+#
+#   Description: Range process rover ApRES .dat files into a single profile
+#                image (row x range bin, complex) saved as chunked HDF5.
+#                Python replacement for the fmcw_load/fmcw_range loops in
+#                plot_bulge_profile_kinematic.m and plot_bulge_profile_stopgo.m,
+#                so it can run on headless processing nodes.
+#
+#   Requires: impdar (Src/PulseEKKO), h5py
+#
+#   Usage:
+#
+#       python build_bulge_profile.py Raw/ApRES/Rover/HF/Kinematic/*.dat -o profile.h5
+#       python build_bulge_profile.py Raw/ApRES/Rover/HF/StartStop -o profile.h5 --stack
+#
+import argparse
+import os
+import pathlib
+import sys
+
+# Add Src/PulseEKKO to the path to use impdar
+__file__path__ = pathlib.Path(os.path.realpath(__file__))
+sys.path.insert(0, str(__file__path__.parents[4] / "PulseEKKO"))
+
+from impdar.lib.ApresData.ApresProfile import build_profile
+
+parser = argparse.ArgumentParser(description="Build an ApRES profile image from rover bursts")
+parser.add_argument("inputs", nargs="+", help=".dat files, or folders of them")
+parser.add_argument("-o", "--output", required=True, help="h5 file to write")
+parser.add_argument("--pad", type=int, default=2, help="FFT pad factor")
+parser.add_argument("--max-range", type=float, default=1500, help="deepest range to keep (m)")
+parser.add_argument("--stack", action="store_true",
+                    help="one row per burst (stop-and-go) rather than one per chirp (kinematic)")
+parser.add_argument("--batch", type=int, default=16, help="bursts to transform at once")
+parser.add_argument("--float32", action="store_true", help="single precision image")
+parser.add_argument("--compression", default=None, help="h5 compression filter, e.g. gzip or lzf")
+args = parser.parse_args()
+
+# Folders are expanded to their .dat files, sorted by name (i.e. time)
+files = []
+for path in map(pathlib.Path, args.inputs):
+    if path.is_dir():
+        files.extend(sorted(str(f) for f in path.glob("*.dat")))
+    else:
+        files.append(str(path))
+
+if len(files) == 0:
+    raise FileNotFoundError("No .dat files found. Has the data been downloaded?")
+
+print(f"Processing {len(files)} files into {args.output}...")
+build_profile(
+    files,
+    args.output,
+    p=args.pad,
+    max_range=args.max_range,
+    stack_chirps=args.stack,
+    batch_size=args.batch,
+    precision="float32" if args.float32 else "float64",
+    compression=args.compression
+)
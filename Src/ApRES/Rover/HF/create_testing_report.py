@@ -5,6 +5,7 @@ import pathlib
 import pyapres 
 import re
 import SQL.catalogue_data as apresdb
+from range_cache import RangeCache
 
 ucl_blue = (0, 151/255, 169/255)
 ucl_orange = (234/255, 118/255, 0)
@@ -17,6 +18,27 @@ ROOT_PATH = pathlib.Path("/mnt/storage/JH_PhD/ReMeltRadar")
 DB_PATH = ROOT_PATH / pathlib.Path("Doc/ApRES/Rover/HF/Testing.db")
 
 FIG_PATH = ROOT_PATH / "Doc/ApRES/Rover/HF/Testing/figures"
+CACHE_PATH = ROOT_PATH / "Doc/ApRES/Rover/HF/Testing/range_cache"
+
+PAD_FACTOR = 2
+
+range_cache = RangeCache(CACHE_PATH)
+
+def process_burst(path):
+    """Attenuator-averaged chirps and their range profiles for a raw file."""
+    burst = pyapres.read(path)
+    burst.load()
+
+    # chirp k + m*n_att is attenuator k of sub-burst m, so average over m
+    n_att = burst.nAttenuators
+    chirp_avg = np.mean(
+        np.reshape(burst.chirp_voltage[:n_att*burst.NSubBursts,:],
+                   (burst.NSubBursts, n_att, -1)),
+        axis=0)
+
+    # Get range profile
+    power = pyapres.RangeProfile.calculate_from_chirp([], chirp_avg, burst.fmcw_parameters, pad_factor=PAD_FACTOR)
+    return {"chirp_time": burst.chirp_time(), "chirp_avg": chirp_avg, "power": power}
 
 db_man = apresdb.ApRESDatabase(DB_PATH)
 cursor = db_man.get_cursor()
@@ -55,30 +77,24 @@ with open(f"{ROOT_PATH}/Doc/ApRES/Rover/HF/Testing/file_doc.tex", "w+") as fh:
         
     for result in cursor.fetchall():
 
-
-        print(f"Print loading {result[1]}...")
-        burst = pyapres.read(ROOT_PATH / result[2])
-        burst.load()
-
         fig_name = f"{FIG_PATH}/{result[1]}.png"
         
         if False: #pathlib.Path(fig_name).exists():
             print(f"Skipping creating figure for {fig_name}")
         else:
 
-            n_att = burst.nAttenuators
-            chirp_avg = np.zeros((n_att, np.size(burst.chirp_voltage,1)))
-            for k in range(n_att):
-                for m in range(burst.NSubBursts):
-                    print(k + m*n_att)
-                    chirp_avg[k,:] = chirp_avg[k,:] + burst.chirp_voltage[k + m*n_att,:]
-                chirp_avg[k,:] = chirp_avg[k,:] / burst.NSubBursts
-            print("-" * 80)
+            # loading and range processing are skipped if this file was done before
+            spectra = range_cache.get_or_compute(
+                ROOT_PATH / result[2],
+                lambda: process_burst(ROOT_PATH / result[2]),
+                stack="attenuator", pad_factor=PAD_FACTOR, profile="pyapres.RangeProfile")
+            chirp_avg = spectra["chirp_avg"]
+            power = spectra["power"]
 
             fig, axs = plt.subplots(2)
 
             for idx in range(np.size(chirp_avg,0)):
-                axs[0].plot(burst.chirp_time(), chirp_avg[idx,:], label=f"Attn {idx+1}", color=line_colors[idx])
+                axs[0].plot(spectra["chirp_time"], chirp_avg[idx,:], label=f"Attn {idx+1}", color=line_colors[idx])
             axs[0].set_xlabel("Time (s)")
             axs[0].set_ylabel("Voltage (V)")
             axs[0].set_ylim([0, 2.5])
@@ -86,8 +102,6 @@ with open(f"{ROOT_PATH}/Doc/ApRES/Rover/HF/Testing/file_doc.tex", "w+") as fh:
             axs[0].set_title(f"Deramped Signal") #T: {result[11]}, F: {result[12]/1e6}-{result[13]/1e6} MHz, RF: {result[9]}, AF:{result[10]}")
             axs[0].legend(loc="lower right")
 
-            # Get range profile
-            power = pyapres.RangeProfile.calculate_from_chirp([], chirp_avg, burst.fmcw_parameters, pad_factor=2)
             range_vec = 3e8 / (4 * (result[13] - result[12]) * np.sqrt(3.18)) * np.arange(0,np.size(power,1))
             
             # Check whether base is visible
@@ -0,0 +1,146 @@
+# Cache of ApRES range spectra on disk
+#
+#   Description: Stores the arrays computed from a burst (stacked chirps,
+#                range profile, ...) under a key made from the checksum of
+#                the raw file and the processing parameters, so reruns of
+#                the reporting scripts skip loading and range processing.
+#                The cache is bounded in size; the least recently used
+#                entries are removed first.
+#
+#   Usage:
+#
+#       cache = RangeCache("/path/to/cache")
+#       arrays = cache.get_or_compute(path, compute, pad_factor=2, window="blackman")
+#
+#   where compute() returns a dict of numpy arrays.
+#
+
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import zipfile
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = pathlib.Path(
+    os.environ.get("APRES_RANGE_CACHE", pathlib.Path.home() / ".cache" / "apres_range"))
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+CHECKSUM_FILE = "checksums.json"
+HASH_BLOCK = 1024**2
+
+
+class RangeCache:
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+
+        self.path = pathlib.Path(cache_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        # checksums of raw files, only recomputed if the size or mtime changes
+        self._checksum_path = self.path / CHECKSUM_FILE
+        try:
+            with open(self._checksum_path, "r") as fh:
+                self._checksums = json.load(fh)
+        except (OSError, ValueError):
+            self._checksums = {}
+
+    def file_checksum(self, path):
+        """SHA-256 of the contents of a file."""
+        path = pathlib.Path(path).resolve()
+        stat = path.stat()
+        stamp = [stat.st_size, stat.st_mtime_ns]
+
+        entry = self._checksums.get(str(path))
+        if entry is not None and entry["stamp"] == stamp:
+            return entry["sha256"]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(HASH_BLOCK), b""):
+                sha.update(block)
+        self._checksums[str(path)] = {"stamp": stamp, "sha256": sha.hexdigest()}
+        self._write_json(self._checksum_path, self._checksums)
+        return sha.hexdigest()
+
+    def key(self, path, **params):
+        """Cache key for a raw file processed with the given parameters."""
+        description = json.dumps(
+            {"sha256": self.file_checksum(path), "params": params},
+            sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key):
+        """The cached arrays for a key as a dict, or None if there are none."""
+        entry = self.path / f"{key}.npz"
+        try:
+            with np.load(entry) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+            # a corrupt or truncated entry counts as a miss, remove it to be recomputed
+            try:
+                entry.unlink()
+            except OSError:
+                pass
+            return None
+        # mark as recently used
+        os.utime(entry)
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a dict of arrays under a key, then trim the cache to size."""
+        # write to a temporary file and rename so readers never see half an entry
+        fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                np.savez(fh, **arrays)
+            os.replace(tmp_name, self.path / f"{key}.npz")
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+        self.evict()
+
+    def get_or_compute(self, path, compute, **params):
+        """Cached arrays for path and params, calling compute() to make them on a miss."""
+        key = self.key(path, **params)
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        return arrays
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for entry in self.path.glob("*.npz"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """Remove every cached entry."""
+        for entry in self.path.glob("*.npz"):
+            entry.unlink()
+
+    def _write_json(self, path, obj):
+        fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as fh:
+            json.dump(obj, fh)
+        os.replace(tmp_name, path)
@@ -1,8 +1,16 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import numpy as np
+import os
 import pathlib
 import pyapres 
+import sys
+
+# Add the rover HF directory to the path to use range_cache
+__file__path__ = pathlib.Path(os.path.realpath(__file__))
+sys.path.insert(0, str(__file__path__.parents[1] / "ApRES/Rover/HF"))
+
+from range_cache import RangeCache
 
 ucl_blue = (0, 151/255, 169/255)
 ucl_orange = (234/255, 118/255, 0)
@@ -18,30 +26,39 @@ FIG_PATH = pathlib.Path("Doc/Tex/Figures/CApRES/test_burst_2022-01-10_184911.png
 
 labels = ["HH", "HV", "VH", "VV"]
 
-burst = pyapres.read(FILE_PATH)[0]
-burst.load()
+PAD_FACTOR = 2
+
+def process_burst(path):
+    """Antenna-pair averaged chirps and their range profiles for the first burst of a file."""
+    burst = pyapres.read(path)[0]
+    burst.load()
+
+    # chirp k + m*n_ant is antenna pair k of sub-burst m, so average over m
+    n_ant = burst.number_of_rx() * burst.number_of_tx()
+    chirp_avg = np.mean(
+        np.reshape(burst.chirp_voltage[:n_ant*burst.NSubBursts,:], (burst.NSubBursts, n_ant, -1)),
+        axis=0)
+
+    # Get range profile
+    power = pyapres.RangeProfile.calculate_from_chirp([], chirp_avg, burst.fmcw_parameters, pad_factor=PAD_FACTOR)
+    return {"chirp_time": burst.chirp_time(), "chirp_avg": chirp_avg, "power": power}
 
-n_ant = burst.number_of_rx() * burst.number_of_tx()
-chirp_avg = np.zeros((n_ant, np.size(burst.chirp_voltage,1)))
-for k in range(n_ant):
-    for m in range(burst.NSubBursts):
-        print(k + m*n_ant)
-        chirp_avg[k,:] = chirp_avg[k,:] + burst.chirp_voltage[k + m*n_ant,:]
-    chirp_avg[k,:] = chirp_avg[k,:] / burst.NSubBursts
-print("-" * 80)
+spectra = RangeCache().get_or_compute(
+    FILE_PATH, lambda: process_burst(FILE_PATH),
+    burst=0, stack="antenna", pad_factor=PAD_FACTOR, profile="pyapres.RangeProfile")
+chirp_avg = spectra["chirp_avg"]
+power = spectra["power"]
 
 fig, axs = plt.subplots(2)
 
 for idx in range(np.size(chirp_avg,0)):
-    axs[0].plot(burst.chirp_time(), chirp_avg[idx,:], label=labels[idx], color=line_colors[idx])
+    axs[0].plot(spectra["chirp_time"], chirp_avg[idx,:], label=labels[idx], color=line_colors[idx])
 axs[0].set_xlabel("Time (s)")
 axs[0].set_ylabel("Voltage (V)")
 axs[0].set_ylim([0, 2.5])
 axs[0].set_xlim([0, 1])
 axs[0].set_title(f"Deramped Signal") #T: {result[11]}, F: {result[12]/1e6}-{result[13]/1e6} MHz, RF: {result[9]}, AF:{result[10]}")
 
-# Get range profile
-power = pyapres.RangeProfile.calculate_from_chirp([], chirp_avg, burst.fmcw_parameters, pad_factor=2)
 range_vec = 3e8 / (4 * (2e8) * np.sqrt(3.18)) * np.arange(0,np.size(power,1))
 
 # # Check whether base is visible
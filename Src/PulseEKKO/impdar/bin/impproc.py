@@ -84,6 +84,11 @@ def _get_args():
                                 type=int,
                                 help='Number of traces to stack. \
                                         Must be an odd number')
+    parser_restack.add_argument('-method',
+                                type=str,
+                                default='mean',
+                                choices=['mean', 'median'],
+                                help='Average the traces with the mean or median')
     _add_def_args(parser_restack)
 
     # Range gain
@@ -108,6 +113,11 @@ def _get_args():
                             type=int,
                             default=50,
                             help='Number of samples to average')
+    parser_agc.add_argument('-mode',
+                            type=str,
+                            default='global',
+                            choices=['global', 'trace'],
+                            help='Gain from the max amplitude across all traces (global) or of each trace')
     _add_def_args(parser_agc)
 
     # Vertical bandpass
@@ -460,9 +470,9 @@ def nmo(dat, ant_sep=0.0, uice=1.69e8, uair=3.0e8, rho_profile=None, **kwargs):
     dat.nmo(ant_sep, uice=uice, uair=uair, rho_profile=rho_profile)
 
 
-def restack(dat, traces=1, **kwargs):
+def restack(dat, traces=1, method='mean', **kwargs):
     """Restack to reduce size/noise."""
-    dat.restack(traces)
+    dat.restack(traces, method=method)
 
 
 def rgain(dat, slope=0.1, **kwargs):
@@ -470,9 +480,9 @@ def rgain(dat, slope=0.1, **kwargs):
     dat.rangegain(slope)
 
 
-def agc(dat, window=50, scale_factor=50, **kwargs):
+def agc(dat, window=50, scale_factor=50, mode='global', **kwargs):
     """Automatically control gain."""
-    dat.agc(window=window, scaling_factor=scale_factor)
+    dat.agc(window=window, scaling_factor=scale_factor, mode=mode)
 
 
 def interp(dats, spacing, gps_fn, offset=0.0, minmove=1.0e-2,
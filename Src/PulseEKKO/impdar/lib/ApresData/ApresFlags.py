@@ -43,9 +43,10 @@ class ApresFlags():
     def __init__(self):
         self.file_read_code = None
         self.phase2range = 0
+        self.range = 0
         self.stack = 1
-        self.attrs = ['file_read_code', 'phase2range', 'stack']
-        self.attr_dims = [None, None, None]
+        self.attrs = ['file_read_code', 'phase2range', 'range', 'stack']
+        self.attr_dims = [None, None, None, None]
 
     def write_h5(self, grp):
         """Write to a subgroup in hdf5 file
@@ -83,6 +84,9 @@ class ApresFlags():
         """Associate all values from an incoming .mat file (i.e. a dictionary from :func:`scipy.io.loadmat`) with appropriate attributes
         """
         for attr, attr_dim in zip(self.attrs, self.attr_dims):
+            if attr not in matlab_struct.dtype.names:
+                # files saved before the flag existed keep the default (e.g. range=0)
+                continue
             setattr(self, attr, matlab_struct[attr][0][0][0])
             # Use this because matlab inputs may have zeros for flags that
             # were lazily appended to be arrays, but we preallocate
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Distributed under terms of the GNU GPL3 license.
+
+"""
+Chunked HDF5 storage of ApRES cubes
+
+The (bnum, cnum, snum) arrays are stored chunked by burst, chirp and a block
+of range bins, so that a few bursts or a depth window can be read without
+touching the rest of the file.
+"""
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+import h5py
+
+#: Largest number of samples (range bins) in one chunk of a cube
+CHUNK_SAMPLES = 4096
+
+#: Values with one entry per burst, which grow when bursts are appended to an archive
+PER_BURST_ATTRS = ['data',
+                   'Rfine',
+                   'decday',
+                   'chirp_num',
+                   'chirp_att',
+                   'chirp_time',
+                   'temperature1',
+                   'temperature2',
+                   'battery_voltage',
+                   'stack_count',
+                   'time_stamp']
+
+
+def encode_time_stamp(time_stamp):
+    """Burst time stamps (datetime objects) as the ISO strings they are stored as."""
+    return np.asarray(time_stamp).astype('datetime64[s]').astype('S19')
+
+
+def decode_time_stamp(val):
+    """Stored ISO strings back to an array of datetime objects."""
+    return np.asarray(val).astype('datetime64[s]').astype(object)
+
+
+def cube_chunks(shape, chunks=None):
+    """The chunk shape to store a (bnum, cnum, snum) cube with.
+
+    Parameters
+    ----------
+    shape: tuple
+        shape of the cube
+    chunks: tuple, optional
+        explicit chunk shape. Default is one chirp of one burst,
+        split into blocks of at most CHUNK_SAMPLES samples.
+    """
+    if chunks is not None:
+        return tuple(min(c, s) for c, s in zip(chunks, shape))
+    return (1, 1, max(1, min(shape[-1], CHUNK_SAMPLES)))
+
+
+class ApresH5Data(NDArrayOperatorsMixin):
+    """Read-only view of a cube in an h5 file, read only where it is indexed.
+
+    data[ib, ic, :] or data[:, :, i0:i1] read just those samples from disk
+    (this is plain h5py indexing, so index arrays must be increasing).
+    Otherwise the view falls back to an ndarray of the whole cube: np.asarray,
+    numpy functions, ufuncs and arithmetic (data * 2, np.abs(data)),
+    and .real or .imag all read everything and return ndarrays.
+
+    Parameters
+    ----------
+    fn: str
+        h5 file name
+    path: str
+        path of the dataset in the file, e.g. 'dat/data'
+    dtype: np.dtype, optional
+        type to return the values as. Default is the stored type.
+    """
+
+    def __init__(self, fn, path, dtype=None):
+        self.fn = fn
+        self.path = path
+        self._file = None
+        dset = self._dataset()
+        self.shape = dset.shape
+        self.dtype = np.dtype(dtype) if dtype is not None else dset.dtype
+
+    def _dataset(self):
+        if self._file is None:
+            self._file = h5py.File(self.fn, 'r')
+        return self._file[self.path]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return np.asarray(self._dataset()[key]).astype(self.dtype, copy=False)
+
+    def __array__(self, dtype=None):
+        out = self[...]
+        if dtype is not None:
+            out = out.astype(dtype, copy=False)
+        return out
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if any(isinstance(out, ApresH5Data) for out in kwargs.get('out', ())):
+            # the view is read-only
+            return NotImplemented
+        inputs = tuple(np.asarray(val) if isinstance(val, ApresH5Data) else val for val in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    @property
+    def real(self):
+        return np.asarray(self).real
+
+    @property
+    def imag(self):
+        return np.asarray(self).imag
+
+    def astype(self, dtype, copy=True):
+        return np.asarray(self).astype(dtype, copy=copy)
+
+    def iter_chunks(self, chunk_size):
+        """Yield (slice, values) over the first axis, chunk_size entries at a time."""
+        for start in range(0, len(self), chunk_size):
+            sl = slice(start, min(start + chunk_size, len(self)))
+            yield sl, self[sl]
+
+    def close(self):
+        """Close the file (it is reopened if the data are indexed again)."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __getstate__(self):
+        # open h5 files cannot be pickled, the copy reopens its own
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
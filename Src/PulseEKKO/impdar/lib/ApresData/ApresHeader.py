@@ -23,9 +23,48 @@ Earth and Space Sciences
 Sept 23 2019
 
 """
+import os
+import ast
+import re
+from functools import lru_cache
+
 import numpy as np
 import h5py
-import re
+
+#: Every key=value line of a burst header, matched in one pass
+HEADER_FIELD_RE = re.compile(r'^([^=\r\n]+)=([^\r\n]*)', re.MULTILINE)
+END_HEADER = '*** End Header ***'
+
+
+def parse_header(header):
+    """
+    Split a burst header into a dictionary of its key=value pairs.
+
+    Parameters
+    ---------
+    header: bytes or string
+        the header, as read from the file. Anything after the end of the header is ignored.
+
+    Output
+    ---------
+    fields: dict
+        values (as strings, with any quotes removed) keyed by the header keys
+    """
+    if isinstance(header, bytes):
+        header = header.decode('latin-1')
+    end = header.find(END_HEADER)
+    if end != -1:
+        header = header[:end]
+    return {key.strip(): val.strip().strip('"') for key, val in HEADER_FIELD_RE.findall(header)}
+
+
+@lru_cache(maxsize=4096)
+def _read_header(fn_apres, burst_pointer, max_header_len, file_key):
+    """Read and tokenize one burst header. Cached per file, burst offset and file version (file_key)."""
+    with open(fn_apres, 'rb') as fid:
+        fid.seek(burst_pointer)
+        header = fid.read(max_header_len)
+    return str(header), parse_header(header)
 
 
 class ApresHeader():
@@ -38,6 +77,7 @@ class ApresHeader():
         self.fs = 4e4
         self.fn = None
         self.header_string = None
+        self.header_fields = None
         self.file_format = None
         self.noDwellHigh = None
         self.noDwellLow = None
@@ -54,7 +94,7 @@ class ApresHeader():
         self.nchirp_samples = None
         self.ramp_dir = None
 
-    def read_header(self,fn_apres,max_header_len=2000):
+    def read_header(self,fn_apres,max_header_len=2000,burst_pointer=0):
         """
         Read the header string, to be partitioned later
 
@@ -64,14 +104,30 @@ class ApresHeader():
             file name to update with
         max_header_len: int
             maximum length of header to read (can be too long)
+        burst_pointer: int
+            byte offset of the burst header in the file (0 for the first burst)
 
         Output
         ---------
         """
         self.fn = fn_apres
-        fid = open(fn_apres,'rb')
-        self.header_string = str(fid.read(max_header_len))
-        fid.close()
+        stat = os.stat(fn_apres)
+        self.header_string, self.header_fields = _read_header(
+            os.path.abspath(fn_apres), burst_pointer, max_header_len, (stat.st_size, stat.st_mtime_ns))
+
+    def get_header_fields(self):
+        """
+        The key=value pairs of the header as a dictionary, tokenizing the header string if needed
+        """
+        if self.header_fields is None:
+            if self.header_string is None:
+                raise TypeError('The header has not been read yet.')
+            header = self.header_string
+            if header[:2] in ["b'", 'b"']:
+                # the header string is the repr of the bytes read from file
+                header = ast.literal_eval(header)
+            self.header_fields = parse_header(header)
+        return self.header_fields
 
     def get_file_format(self):
         """
@@ -124,74 +180,55 @@ class ApresHeader():
         if self.file_format is None:
             self.get_file_format()
 
-        loc1 = [m.start() for m in re.finditer('Reg0', self.header_string)]
-        loc2 = [m.start() for m in re.finditer('="', self.header_string)]
-
-        for k in range(len(loc1)):
-            case = self.header_string[loc1[k]:loc2[k]]
-
-            if case == 'Reg01':
-                # Control Function Register 2 (CFR2) Address 0x01 Four bytes
-                # Bit 19 (Digital ramp enable)= 1 = Enables digital ramp generator functionality.
-                # Bit 18 (Digital ramp no-dwell high) 1 = enables no-dwell high functionality.
-                # Bit 17 (Digital ramp no-dwell low) 1 = enables no-dwell low functionality.
-                # With no-dwell high, a positive transition of the DRCTL pin initiates a positive slope ramp, which
-                # continues uninterrupted (regardless of any activity on the DRCTL pin) until the upper limit is reached.
-                # Setting both no-dwell bits invokes a continuous ramping mode of operation;
-                loc3 = self.header_string[loc2[k]+2:].find('"')
-                val = self.header_string[loc2[k]+2:loc2[k]+loc3+2]
-                val = bin(int(val, 16))
-                val = val[::-1]
-                self.noDwellHigh = int(val[18])
-                self.noDwellLow = int(val[17])
-
-            #elif case == 'Reg08':
-            #    # Phase offset word Register (POW) Address 0x08. 2 Bytes dTheta = 360*POW/2^16.
-            #    val = char(reg{1,2}(k));
-            #    H.phaseOffsetDeg = hex2dec(val(1:4))*360/2^16;
-
-            elif case == 'Reg0B':
-                # Digital Ramp Limit Register Address 0x0B
-                # Digital ramp upper limit 32-bit digital ramp upper limit value.
-                # Digital ramp lower limit 32-bit digital ramp lower limit value.
-                loc3 = self.header_string[loc2[k]+2:].find('"')
-                val = self.header_string[loc2[k]+2:loc2[k]+loc3+2]
-                self.f0 = int(val[8:], 16)*self.fsysclk/(2**32)
-                self.f_stop = int(val[:8], 16)*self.fsysclk/(2**32)
-
-            elif case == 'Reg0C':
-                # Digital Ramp Step Size Register Address 0x0C
-                # Digital ramp decrement step size 32-bit digital ramp decrement step size value.
-                # Digital ramp increment step size 32-bit digital ramp increment step size value.
-                loc3 = self.header_string[loc2[k]+2:].find('"')
-                val = self.header_string[loc2[k]+2:loc2[k]+loc3+2]
-                self.ramp_up_step = int(val[8:], 16)*self.fsysclk/(2**32)
-                self.ramp_down_step = int(val[:8], 16)*self.fsysclk/(2**32)
-
-            elif case == 'Reg0D':
-                # Digital Ramp Rate Register Address 0x0D
-                # Digital ramp negative slope rate 16-bit digital ramp negative slope value that defines the time interval between decrement values.
-                # Digital ramp positive slope rate 16-bit digital ramp positive slope value that defines the time interval between increment values.
-                loc3 = self.header_string[loc2[k]+2:].find('"')
-                val = self.header_string[loc2[k]+2:loc2[k]+loc3+2]
-                self.tstep_up = int(val[4:], 16)*4/self.fsysclk
-                self.tstep_down = int(val[:4], 16)*4/self.fsysclk
-
-        strings = ['SamplingFreqMode=','N_ADC_SAMPLES=']
-        output = np.empty((len(strings))).astype(str)
-        for i,string in enumerate(strings):
-            if string in self.header_string:
-                search_start = self.header_string.find(string)
-                search_end = self.header_string[search_start:].find('\\')
-                output[i] = self.header_string[search_start+len(string):search_end+search_start]
-
-        self.fs = output[0]
-        if self.fs == 1:        # if self.fs > 70e3:
-            self.fs = 8e4       #     self.fs = 80e3
-        else:                   # else
-            self.fs = 4e4       #     self.fs = 40e3
-
-        self.snum = int(output[1])
+        fields = self.get_header_fields()
+
+        if 'Reg01' in fields:
+            # Control Function Register 2 (CFR2) Address 0x01 Four bytes
+            # Bit 19 (Digital ramp enable)= 1 = Enables digital ramp generator functionality.
+            # Bit 18 (Digital ramp no-dwell high) 1 = enables no-dwell high functionality.
+            # Bit 17 (Digital ramp no-dwell low) 1 = enables no-dwell low functionality.
+            # With no-dwell high, a positive transition of the DRCTL pin initiates a positive slope ramp, which
+            # continues uninterrupted (regardless of any activity on the DRCTL pin) until the upper limit is reached.
+            # Setting both no-dwell bits invokes a continuous ramping mode of operation;
+            val = int(fields['Reg01'], 16)
+            self.noDwellHigh = (val >> 18) & 1
+            self.noDwellLow = (val >> 17) & 1
+
+        #if 'Reg08' in fields:
+        #    # Phase offset word Register (POW) Address 0x08. 2 Bytes dTheta = 360*POW/2^16.
+        #    val = char(reg{1,2}(k));
+        #    H.phaseOffsetDeg = hex2dec(val(1:4))*360/2^16;
+
+        if 'Reg0B' in fields:
+            # Digital Ramp Limit Register Address 0x0B
+            # Digital ramp upper limit 32-bit digital ramp upper limit value.
+            # Digital ramp lower limit 32-bit digital ramp lower limit value.
+            val = fields['Reg0B']
+            self.f0 = int(val[8:], 16)*self.fsysclk/(2**32)
+            self.f_stop = int(val[:8], 16)*self.fsysclk/(2**32)
+
+        if 'Reg0C' in fields:
+            # Digital Ramp Step Size Register Address 0x0C
+            # Digital ramp decrement step size 32-bit digital ramp decrement step size value.
+            # Digital ramp increment step size 32-bit digital ramp increment step size value.
+            val = fields['Reg0C']
+            self.ramp_up_step = int(val[8:], 16)*self.fsysclk/(2**32)
+            self.ramp_down_step = int(val[:8], 16)*self.fsysclk/(2**32)
+
+        if 'Reg0D' in fields:
+            # Digital Ramp Rate Register Address 0x0D
+            # Digital ramp negative slope rate 16-bit digital ramp negative slope value that defines the time interval between decrement values.
+            # Digital ramp positive slope rate 16-bit digital ramp positive slope value that defines the time interval between increment values.
+            val = fields['Reg0D']
+            self.tstep_up = int(val[4:], 16)*4/self.fsysclk
+            self.tstep_down = int(val[:4], 16)*4/self.fsysclk
+
+        if fields.get('SamplingFreqMode') == '1':
+            self.fs = 8e4
+        else:
+            self.fs = 4e4
+
+        self.snum = int(fields['N_ADC_SAMPLES'])
 
         self.nsteps_DDS = round(abs((self.f_stop - self.f0)/self.ramp_up_step)) # abs as ramp could be down
         self.chirp_length = int(self.nsteps_DDS * self.tstep_up)
@@ -222,6 +259,9 @@ class ApresHeader():
         """
         subgrp = grp.create_group('ApresHeader')
         for attr in vars(self):
+            if attr == 'header_fields':
+                # derived from header_string, so there is no need to store it
+                continue
             val = getattr(self, attr)
             if val is None:
                 subgrp.attrs[attr] = h5py.Empty("f")
@@ -241,7 +281,8 @@ class ApresHeader():
     def to_matlab(self):
         """Convert all associated attributes into a dictionary formatted for use with :func:`scipy.io.savemat`
         """
-        outmat = {att: (getattr(self, att) if getattr(self, att) is not None else np.NaN) for att in vars(self)}
+        outmat = {att: (getattr(self, att) if getattr(self, att) is not None else np.NaN) for att in vars(self)
+                  if att != 'header_fields'}
         return outmat
 
     def from_matlab(self, matlab_struct):
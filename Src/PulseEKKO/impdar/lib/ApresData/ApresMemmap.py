@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Distributed under terms of the GNU GPL3 license.
+
+"""
+Lazily scaled, memory-mapped ApRES samples
+
+The ADC counts stay on disk as they were written (uint16, or uint32 for
+averaged bursts) and are only converted to volts for the part of the array
+that is indexed.
+"""
+import numpy as np
+
+
+class ApresMemmap(object):
+    """Read-only view of raw ADC counts that yields voltages when indexed.
+
+    Indexing returns a new float array for just the selected samples,
+    so data[ib, ic, :] or data[:10] never touch the rest of the file.
+    Anything that calls np.asarray on the object gets the whole record in volts.
+
+    Parameters
+    ----------
+    raw: np.memmap or np.ndarray
+        ADC counts, shaped (cnum, snum) or (bnum, cnum, snum)
+    scale: float
+        volts per count
+    dtype: np.dtype, optional
+        float type of the voltages that are returned. Default float64.
+    """
+
+    def __init__(self, raw, scale, dtype=np.float64):
+        self.raw = raw
+        self.scale = scale
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        return self.raw.ndim
+
+    @property
+    def size(self):
+        return self.raw.size
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        return np.multiply(self.raw[key], self.scale, dtype=self.dtype)
+
+    def __array__(self, dtype=None):
+        out = self[...]
+        if dtype is not None:
+            out = out.astype(dtype, copy=False)
+        return out
+
+    def reshape(self, *shape):
+        """Reshape the view of the raw counts (no data are read)."""
+        return ApresMemmap(self.raw.reshape(*shape), self.scale, self.dtype)
+
+    def iter_chunks(self, chunk_size):
+        """Yield (slice, voltages) over the first axis, chunk_size entries at a time."""
+        for start in range(0, len(self), chunk_size):
+            sl = slice(start, min(start + chunk_size, len(self)))
+            yield sl, self[sl]
@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Distributed under terms of the GNU GPL3 license.
+
+"""
+Range-processed profile images from moving (rover) ApRES surveys
+
+Every burst of one or more .dat files is range processed and written as
+rows of a single (row x range bin) complex image in an h5 file. The image is
+allocated once from the burst index, and bursts are transformed in batches.
+"""
+import numpy as np
+import h5py
+
+from .ApresH5Store import CHUNK_SAMPLES
+from ._ApresDataProcessing import float_dtypes
+from .load_apres import CHIRP_INTERVAL, load_apres_single_file, load_burst_index, _to_decday
+
+#: Rows in one chunk of the image
+CHUNK_ROWS = 256
+
+
+def build_profile(fns_apres, fn_out, p=2, max_range=1500, winfun='blackman', stack_chirps=False,
+                  batch_size=16, precision='float64', compression=None, compression_opts=None,
+                  groupname='profile'):
+    """
+    Range process whole ApRES files into one profile image in an h5 file.
+
+    Each chirp is a row of the image (kinematic surveys), or, with
+    stack_chirps, the mean spectrum of each burst is (stop-and-go surveys).
+
+    Parameters
+    ---------
+    fns_apres: string or list of strings
+        raw .dat files, in profile order
+    fn_out: string
+        h5 file to write
+    p: int
+        pad factor, level of interpolation for fft
+    max_range: float
+        deepest range bin to keep (m)
+    winfun: str
+        window function for fft
+    stack_chirps: bool
+        one row per burst (mean of its chirp spectra) rather than one per chirp
+    batch_size: int
+        number of bursts to read and transform at once
+    precision: str
+        'float64' or 'float32' (complex64 image)
+    compression: str, optional
+        h5py compression filter for the image, e.g. 'gzip' or 'lzf'
+    compression_opts: optional
+        options for the filter, e.g. the gzip level
+    groupname: string
+        group to write in the file
+
+    Output
+    ---------
+    The group holds the image (rows x range bins, spectrum with the reference
+    phase removed, as ApresData.data after apres_range), Rcoarse, and for
+    each row the decday, the file index and the burst (and chirp) number.
+    """
+    if isinstance(fns_apres, str):
+        fns_apres = [fns_apres]
+
+    indices = [load_burst_index(fn) for fn in fns_apres]
+    if stack_chirps:
+        nrows = sum(len(index) for index in indices)
+    else:
+        nrows = int(sum(np.sum(index['cnum']) for index in indices))
+
+    with h5py.File(fn_out, 'w') as fout:
+        grp = fout.create_group(groupname)
+        grp.attrs['p'] = p
+        grp.attrs['max_range'] = max_range
+        grp.attrs['winfun'] = winfun
+        grp.attrs['stack_chirps'] = stack_chirps
+        grp.create_dataset('files', data=np.array(fns_apres, dtype=h5py.string_dtype()))
+        row_decday = grp.create_dataset('decday', (nrows, ), dtype=np.float64)
+        row_file = grp.create_dataset('file', (nrows, ), dtype=np.int32)
+        row_burst = grp.create_dataset('burst', (nrows, ), dtype=np.int32)
+        row_chirp = grp.create_dataset('chirp', (nrows, ), dtype=np.int32)
+        image = None
+
+        row = 0
+        for i_file, (fn, index) in enumerate(zip(fns_apres, indices)):
+            for batch in _batches(index, batch_size):
+                dat = _load_batch(fn, index, batch, precision)
+                dat.apres_range(p, max_range=max_range, winfun=winfun, keep_spec=False)
+
+                if stack_chirps:
+                    spec = np.mean(dat.data, axis=1)
+                    decday = dat.decday
+                    burst = batch
+                    chirp = np.zeros(len(batch), dtype=int)
+                else:
+                    spec = dat.data.reshape((-1, dat.snum))
+                    decday = np.reshape(dat.chirp_time, (-1, ))
+                    burst = np.repeat(batch, dat.cnum)
+                    chirp = np.tile(np.arange(dat.cnum), len(batch))
+
+                if image is None:
+                    # now the number of range bins is known, the whole image can be allocated
+                    grp.create_dataset('Rcoarse', data=dat.Rcoarse)
+                    image = grp.create_dataset(
+                        'image', (nrows, dat.snum), dtype=spec.dtype,
+                        chunks=(max(1, min(CHUNK_ROWS, nrows)), max(1, min(CHUNK_SAMPLES, dat.snum))),
+                        compression=compression, compression_opts=compression_opts)
+                elif spec.shape[1] != image.shape[1]:
+                    raise ValueError('Need the same number of range bins in every burst')
+
+                rows = slice(row, row + len(spec))
+                image[rows] = spec
+                row_decday[rows] = decday
+                row_file[rows] = i_file
+                row_burst[rows] = burst
+                row_chirp[rows] = chirp
+                row += len(spec)
+
+
+def _batches(index, batch_size):
+    """Runs of up to batch_size consecutive bursts (1-indexed) that have the same shape."""
+    burst = 0
+    while burst < len(index):
+        stop = burst + 1
+        while stop < min(burst + batch_size, len(index)) and \
+                index['cnum'][stop] == index['cnum'][burst] and index['snum'][stop] == index['snum'][burst]:
+            stop += 1
+        yield np.arange(burst, stop) + 1
+        burst = stop
+
+
+def _load_batch(fn, index, bursts, precision):
+    """
+    Several bursts of one file as a single (bnum, cnum, snum) ApresData.
+
+    Only the header of the first burst is parsed (the batch shares its shape).
+    The byte range from the first burst's samples to the end of the last one is
+    mapped once, and each burst is cut out of it at its offset in the index.
+    """
+    records = index[bursts - 1]
+    dat = load_apres_single_file(fn, burst=int(bursts[0]), mmap=True, precision=precision)
+    raw_dtype = dat.data.raw.dtype
+    real_dtype = float_dtypes(precision)[0]
+
+    # Volts per ADC count, as in load_burst
+    scale = np.full(len(records), 2.5/2**16.)
+    averaged = records['average'] == 2
+    scale[averaged] /= records['n_subbursts'][averaged]*records['n_attenuators'][averaged]
+
+    nbytes = dat.cnum*dat.snum*raw_dtype.itemsize
+    offsets = records['data_offset'] - records['data_offset'][0]
+    raw = np.memmap(fn, dtype=np.uint8, mode='r', offset=int(records['data_offset'][0]),
+                    shape=(int(offsets[-1]) + nbytes, ))
+    dat.data = np.empty((len(records), dat.cnum, dat.snum), dtype=real_dtype)
+    for i, offset in enumerate(offsets):
+        counts = raw[offset:offset + nbytes].view(raw_dtype).reshape((dat.cnum, dat.snum))
+        np.multiply(counts, scale[i], out=dat.data[i], dtype=real_dtype)
+    del raw
+
+    dat.decday = np.array([_to_decday(time) for time in records['time_stamp']])
+    dat.chirp_time = dat.decday[:, np.newaxis] + CHIRP_INTERVAL*(dat.chirp_num - 1)
+    dat.bnum = len(records)
+    return dat
@@ -19,9 +19,24 @@ Sept 23 2019
 
 """
 import numpy as np
+import h5py
+from scipy.special import spence
 
+from .. import fftlib
 
-def apres_range(self,p,max_range=4000,winfun='blackman'):
+#: Real and complex dtypes used for each processing precision
+PRECISIONS = {'float64': (np.float64, np.complex128),
+              'float32': (np.float32, np.complex64)}
+
+
+def float_dtypes(precision):
+    """The (real, complex) dtypes for a precision name, 'float64' or 'float32'."""
+    if precision not in PRECISIONS:
+        raise ValueError('precision must be one of %s' % str(list(PRECISIONS.keys())))
+    return PRECISIONS[precision]
+
+
+def apres_range(self,p,max_range=4000,winfun='blackman',chunk_size=None,precision=None,keep_spec=True):
     """
 
     Parameters
@@ -32,6 +47,19 @@ def apres_range(self,p,max_range=4000,winfun='blackman'):
         pad factor, level of interpolation for fft
     winfun: str
         window function for fft
+    chunk_size: int; optional
+        number of bursts to transform at once (bounds the memory used).
+        Default is to transform the whole (bnum, cnum, snum) cube in one call.
+    precision: str; optional
+        'float64' or 'float32'. Default follows the loaded data, so data loaded
+        with precision='float32' give complex64 spectra.
+        In single precision the phase of bins well above the noise floor agrees
+        with double precision to about 1e-5 rad (< 1e-3 mm of range), and the
+        amplitude to a relative 1e-6; bins near the noise floor are less precise.
+    keep_spec: bool; optional
+        also store the uncorrected spectrum as self.spec. If False only the
+        corrected spectrum is kept (half the memory) and self.spec is None;
+        use get_spec to rebuild the uncorrected one when it is needed.
 
     Output
     --------
@@ -63,6 +91,10 @@ def apres_range(self,p,max_range=4000,winfun='blackman'):
     if self.flags.range != 0:
         raise TypeError('The range filter has already been done on these data.')
 
+    if precision is None:
+        precision = 'float32' if np.dtype(self.data.dtype) == np.float32 else 'float64'
+    real_dtype, complex_dtype = float_dtypes(precision)
+
     # Processing settings
     nf = int(np.floor(p*self.snum/2))    # number of frequencies to recover
     # window for fft
@@ -89,48 +121,81 @@ def apres_range(self,p,max_range=4000,winfun='blackman'):
     # Brennan et al. (2014) eq. 17 measured at t=T/2
     self.phiref = 2.*np.pi*self.header.fc*tau -(self.header.chirp_grad*tau**2.)/2
 
-    # --- Loop through for each chirp in burst --- #
-
-    # preallocate
-    spec = np.zeros((self.bnum,self.cnum,nf)).astype(np.cdouble)
-    spec_cor = np.zeros((self.bnum,self.cnum,nf)).astype(np.cdouble)
-
-    for ib in range(self.bnum):
-        for ic in range(self.cnum):
-            # isolate the chirp and preprocess before transform
-            chirp = self.data[ib,ic,:].copy()
-            chirp = chirp-np.mean(chirp) # de-mean
-            chirp *= win # windowed
+    # Crop output variables to useful depth range only
+    n = np.argmin(self.Rcoarse<=max_range)
 
-            # fourier transform
-            fft_chirp = (np.sqrt(2.*p)/len(chirp))*np.fft.fft(chirp,p*self.snum) # fft and scale for padding
-            fft_chirp /= np.sqrt(np.mean(win**2.)) # scale with rms of window
+    # unit phasor with conjugate of phiref phase
+    comp = np.exp(-1j*(self.phiref[:n])).astype(complex_dtype)
+    # scale for padding and with rms of window
+    fft_scale = (np.sqrt(2.*p)/self.snum)/np.sqrt(np.mean(win**2.))
+    win = win.astype(real_dtype)
 
-            # output
-            spec[ib,ic,:] = fft_chirp[:nf] # positive frequency half of spectrum up to (nyquist minus deltaf)
-            comp = np.exp(-1j*(self.phiref)) # unit phasor with conjugate of phiref phase
-            spec_cor[ib,ic,:] = comp*fft_chirp[:nf] # positive frequency half of spectrum with ref phase subtracted
+    # --- Transform all chirps of a chunk of bursts at once --- #
 
-    self.data = spec_cor.copy()
-    self.spec = spec.copy()
+    if chunk_size is None:
+        chunk_size = self.bnum
+    if keep_spec:
+        spec = np.empty((self.bnum,self.cnum,n),dtype=complex_dtype)
+    else:
+        spec = None
+    spec_cor = np.empty((self.bnum,self.cnum,n),dtype=complex_dtype)
+
+    for ib in range(0,self.bnum,chunk_size):
+        bursts = slice(ib,min(ib+chunk_size,self.bnum))
+        # isolate the chirps and preprocess before transform
+        chirps = np.array(self.data[bursts],dtype=real_dtype)
+        chirps -= np.mean(chirps,axis=-1,keepdims=True) # de-mean
+        chirps *= win # windowed
+
+        # fourier transform, positive frequency half of spectrum up to (nyquist minus deltaf)
+        fft_chirps = fftlib.rfft(chirps,p*self.snum,axis=-1)[...,:n]
+        fft_chirps *= fft_scale
+
+        # output
+        if keep_spec:
+            spec[bursts] = fft_chirps
+        fft_chirps *= comp # positive frequency half of spectrum with ref phase subtracted
+        spec_cor[bursts] = fft_chirps
+
+    self.data = spec_cor
+    self.data_dtype = self.data.dtype
+    self.spec = spec
+    self.Rcoarse = self.Rcoarse[:n]
 
-    # precise range measurement
+    # precise range measurement (Rcoarse broadcasts along the last axis)
     self.Rfine = phase2range(np.angle(self.data),self.header.lambdac,
-            np.tile(self.Rcoarse,(self.bnum,self.cnum,1)),
-            self.header.chirp_grad,self.header.ci)
+            self.Rcoarse,
+            self.header.chirp_grad,self.header.ci).astype(real_dtype,copy=False)
 
-    # Crop output variables to useful depth range only
-    n = np.argmin(self.Rcoarse<=max_range)
-    self.Rcoarse = self.Rcoarse[:n]
-    self.Rfine = self.Rfine[:,:,:n]
-    self.data = self.data[:,:,:n]
-    self.spec = self.spec[:,:,:n]
     self.snum = n
 
     self.flags.range = max_range
 
 
-def phase_uncertainty(self):
+def get_spec(self):
+    """
+    The uncorrected spectrum, i.e. before the reference phase is subtracted.
+
+    This is self.spec if apres_range kept it, otherwise it is rebuilt from
+    the corrected spectrum in self.data.
+
+    Output
+    --------
+    spec: array
+        positive frequency half of the spectrum, same shape as self.data
+    """
+
+    if self.flags.range == 0:
+        raise TypeError('The range filter has not been executed on this data class, do that before getting the spectrum.')
+
+    if getattr(self,'spec',None) is not None:
+        return self.spec
+    # undo the reference phase correction, exp(-1j*phiref), bin by bin
+    phasor = np.exp(1j*self.phiref[:self.snum]).astype(self.data.dtype)
+    return self.data*phasor
+
+
+def phase_uncertainty(self,rng=None,mode='random',chunk_size=None,median_mag=None):
     """
     Calculate the phase uncertainty using a noise phasor.
 
@@ -138,6 +203,21 @@ def phase_uncertainty(self):
 
     Parameters
     ---------
+    rng: np.random.Generator or int; optional
+        source (or seed) of the random noise phases.
+        Default uses the global np.random state, as before.
+    mode: str; optional
+        'random' draws one noise phase per sample (the original method).
+        'analytic' gives the expected value of the same quantity over a uniform
+        noise phase, (2/pi)*chi_2(median_mag/|phasor|) with Legendre's chi
+        function, so nothing is drawn. It is NaN where the median magnitude
+        exceeds the magnitude of the phasor.
+    chunk_size: int; optional
+        number of bursts to do at once. Default is all of them.
+        The random draws are made in order, so the result does not depend on this.
+    median_mag: float; optional
+        median magnitude of the data to use for the noise phasor, if already known.
+        Default is to find it, one chunk at a time.
 
     Output
     --------
@@ -152,15 +232,47 @@ def phase_uncertainty(self):
         raise TypeError('The range filter has not been executed on this data class, do that before the uncertainty calculation.')
 
 
+    if mode not in ['random','analytic']:
+        raise ValueError("mode must be 'random' or 'analytic'")
+    if rng is None:
+        rng = np.random
+    else:
+        rng = np.random.default_rng(rng)
+    if chunk_size is None:
+        chunk_size = max(1,len(self.data))
+
+    # The output doubles as the work space for the magnitudes
+    chunks = [slice(ib,min(ib+chunk_size,len(self.data))) for ib in range(0,len(self.data),chunk_size)]
+    phase_uncertainty = np.empty(np.shape(self.data),dtype=np.finfo(self.data.dtype).dtype)
+
     # Get measured phasor from the data class, and use the median magnitude for noise phasor
-    meas_phasor = self.data
-    median_mag = np.nanmedian(abs(meas_phasor))
-    # Noise phasor with random phase and magnitude equal to median of measured phasor
-    noise_phase = np.random.uniform(-np.pi,np.pi,np.shape(meas_phasor))
-    noise_phasor = median_mag*(np.cos(noise_phase)+1j*np.sin(noise_phase))
-    noise_orth = median_mag*np.sin(np.angle(meas_phasor)-np.angle(noise_phasor))
-    # Phase uncertainty is the deviation in the phase introduced by the noise phasor when it is oriented perpendicular to the reflector phasor
-    phase_uncertainty = np.abs(np.arcsin(noise_orth/np.abs(meas_phasor)))
+    if median_mag is None:
+        nvalid = 0
+        for bursts in chunks:
+            out = phase_uncertainty[bursts]
+            np.abs(self.data[bursts],out=out)
+            nvalid += out.size-np.count_nonzero(np.isnan(out))
+        median_mag = _nanmedian_inplace(phase_uncertainty.reshape(-1),nvalid)
+
+    for bursts in chunks:
+        meas_phasor = self.data[bursts]
+        out = phase_uncertainty[bursts]
+        np.abs(meas_phasor,out=out)
+        if mode == 'random':
+            # Noise phasor with random phase and magnitude equal to median of measured phasor
+            noise_phase = rng.uniform(-np.pi,np.pi,np.shape(meas_phasor))
+            # Its component perpendicular to the reflector phasor, median_mag*sin(angle(meas)-noise_phase),
+            # over the reflector magnitude (expanded so no angles are needed)
+            ratio = meas_phasor.imag*np.cos(noise_phase)
+            ratio -= meas_phasor.real*np.sin(noise_phase)
+            ratio *= median_mag
+            ratio /= out**2.
+            # Phase uncertainty is the deviation in the phase introduced by the noise phasor when it is oriented perpendicular to the reflector phasor
+            np.abs(np.arcsin(ratio),out=out)
+        else:
+            # Mean of |arcsin(a*sin(psi))| over a uniform psi is (2/pi)*chi_2(a)
+            out[...] = (2./np.pi)*_legendre_chi2(median_mag/out)
+
     # Convert phase to range
     r_uncertainty = phase2range(phase_uncertainty,
             self.header.lambdac,
@@ -171,6 +283,25 @@ def phase_uncertainty(self):
     return phase_uncertainty, r_uncertainty
 
 
+def _nanmedian_inplace(arr,nvalid):
+    """np.nanmedian of a 1-d array with nvalid non-NaN values, found by partitioning the array itself (its order is lost)."""
+    if nvalid == 0:
+        return np.nan
+    # NaNs are partitioned to the end
+    k = [(nvalid-1)//2,nvalid//2]
+    arr.partition(k)
+    return (arr[k[0]]+arr[k[1]])/2
+
+
+def _legendre_chi2(x):
+    """Legendre's chi function, chi_2(x) = (Li2(x) - Li2(-x))/2, for 0 <= x <= 1 (NaN above)."""
+    x = np.asarray(x,dtype=float)
+    with np.errstate(invalid='ignore'):
+        # scipy's spence(z) is the dilogarithm Li2(1-z)
+        chi = 0.5*(spence(1.-x) - spence(1.+x))
+    return np.where(x <= 1.,chi,np.nan)
+
+
 def phase2range(phi,lambdac,rc=None,K=None,ci=None):
     """
     Convert phase difference to range for FMCW radar
@@ -217,9 +348,9 @@ def range_diff(self,acq1,acq2,win,step,Rcoarse=None,r_uncertainty=None,uncertain
     self: class
         data object
     acq1: array
-        first acquisition for comparison
+        first acquisition for comparison, shape (snum,) or a stack (..., snum)
     acq2: array
-        second acquisition for comparison
+        second acquisition for comparison, same shape as acq1
     win: int
         window size over which to do the correlation coefficient calculation
     step: int
@@ -227,8 +358,10 @@ def range_diff(self,acq1,acq2,win,step,Rcoarse=None,r_uncertainty=None,uncertain
     Rcoarse: array; optional
         if an external depth array is desired, input here
     r_uncertainty: array; optional
-        if unceratinty based on the noise vector is desired input value here
-        this should be the sum of uncertainty from both acquisitions.
+        noise phasor range uncertainty, needed for uncertainty='noise_phasor'.
+        It is used as given, so it should be the sum of the uncertainty of both
+        acquisitions, e.g. r_unc[i1]+r_unc[i2] from phase_uncertainty.
+        (range_diff_series takes the per-burst array and forms this sum itself.)
     uncertainty: string;
         default 'CR' Cramer-Rao bound as in Jordan et al. (2020)
 
@@ -237,30 +370,23 @@ def range_diff(self,acq1,acq2,win,step,Rcoarse=None,r_uncertainty=None,uncertain
     ds: array
         depths at which the correlation coefficient is calculated
     phase_diff: array
-        correlation coefficient between acquisitions
+        correlation coefficient between acquisitions, shape (..., len(ds))
         amplitude indicates how well reflection packets match between acquisitions
         phase is a measure of the vertical motion
     range_diff: array
         vertical motion in meters
+    range_diff_unc: array
+        uncertainty of the vertical motion in meters
     """
 
-    if np.shape(acq1) != np.shape(acq2):
-        raise TypeError('Acquisition inputs must be of the same shape.')
-
-    idxs = np.arange(win//2,(len(acq1)-win//2),step)
+    # correlation coefficient to get the motion
+    # the amplitude indicates how well the reflections match between acquisitions
+    # the phase is a measure of the offset
+    idxs, co = sliding_coherence(acq1,acq2,win,step)
     if Rcoarse is not None:
         ds = Rcoarse[idxs]
     else:
         ds = self.Rcoarse[idxs]
-    co = np.empty_like(ds).astype(np.complex)
-    for i,idx in enumerate(idxs):
-        # index two sub_arrays to compare
-        arr1 = acq1[idx-win//2:idx+win//2]
-        arr2 = acq2[idx-win//2:idx+win//2]
-        # correlation coefficient to get the motion
-        # the amplitude indicates how well the reflections match between acquisitions
-        # the phase is a measure of the offset
-        co[i] = np.corrcoef(arr1,arr2)[1,0]
 
     # convert the phase offset to a distance vector
     r_diff = phase2range(np.angle(co),
@@ -282,12 +408,237 @@ def range_diff(self,acq1,acq2,win,step,Rcoarse=None,r_uncertainty=None,uncertain
     elif uncertainty == 'noise_phasor':
         # Uncertainty from Noise Phasor as in Kingslake et al. (2014)
         # r_uncertainty should be calculated using the function phase_uncertainty defined in this script
-        r_diff_unc = np.array([np.nanmean(r_uncertainty[i-win//2:i+win//2]) for i in idxs])
+        windows = _sliding_windows(np.asarray(r_uncertainty),win,step,len(idxs))
+        r_diff_unc = np.nanmean(windows,axis=-1)
+
+    else:
+        raise ValueError("uncertainty must be 'CR' or 'noise_phasor'")
 
     return ds, co, r_diff, r_diff_unc
 
 
-def stacking(self,num_chirps=None):
+def sliding_coherence(acq1,acq2,win,step):
+    """
+    Complex correlation coefficient of two acquisitions in sliding windows.
+
+    This gives the same values as np.corrcoef(arr1,arr2)[1,0] for every window
+    arr = acq[idx-win//2:idx+win//2], but all windows are done at once.
+    The window sums are reduced over strided views of the inputs, so nothing
+    the size of (number of windows x win) is allocated.
+
+    Parameters
+    ---------
+    acq1: array
+        first acquisition, shape (snum,) or a stack of acquisitions (..., snum)
+    acq2: array
+        second acquisition, same shape as acq1
+    win: int
+        window size over which to do the correlation coefficient calculation
+    step: int
+        step size for the window to move between calculations
+
+    Output
+    --------
+    idxs: array
+        sample index at the centre of each window
+    co: array
+        correlation coefficient for each window, shape (..., len(idxs))
+    """
+
+    acq1 = np.asarray(acq1)
+    acq2 = np.asarray(acq2)
+    if acq1.shape != acq2.shape:
+        raise TypeError('Acquisition inputs must be of the same shape.')
+
+    idxs = np.arange(win//2,(acq1.shape[-1]-win//2),step)
+    n = 2*(win//2)
+
+    # sums over each window
+    s1, s11 = _window_moments(acq1,win,step,len(idxs))
+    s2, s22 = _window_moments(acq2,win,step,len(idxs))
+    s21 = _window_sum(acq2*np.conj(acq1),win,step,len(idxs))
+    co = _coherence(s1,s11,s2,s22,s21,n)
+    return idxs, co
+
+
+def _window_sum(arr,win,step,num):
+    """Sum of arr over each of the first num sliding windows."""
+    return np.sum(_sliding_windows(arr,win,step,num),axis=-1)
+
+
+def _window_moments(arr,win,step,num):
+    """Sum and power sum of arr over each of the first num sliding windows."""
+    return _window_sum(arr,win,step,num), _window_sum(np.real(arr*np.conj(arr)),win,step,num)
+
+
+def _coherence(s1,s11,s2,s22,s21,n):
+    """Correlation coefficient from window sums (x, |x|^2, y, |y|^2, y*conj(x)) over n samples."""
+    # covariance and variances of the de-meaned windows
+    cov = s21 - s2*np.conj(s1)/n
+    var1 = s11 - np.real(s1*np.conj(s1))/n
+    var2 = s22 - np.real(s2*np.conj(s2))/n
+    co = cov/np.sqrt(var1*var2)
+
+    # clip to the unit square as np.corrcoef does
+    if np.iscomplexobj(co):
+        np.clip(co.real,-1,1,out=co.real)
+        np.clip(co.imag,-1,1,out=co.imag)
+    else:
+        np.clip(co,-1,1,out=co)
+    return co
+
+
+def _sliding_windows(arr,win,step,num):
+    """Strided view of the first num windows arr[...,idx-win//2:idx+win//2] along the last axis."""
+    if num == 0 or 2*(win//2) > arr.shape[-1]:
+        # a window longer than the data fits nowhere
+        return np.zeros(arr.shape[:-1]+(0,2*(win//2)),dtype=arr.dtype)
+    windows = np.lib.stride_tricks.sliding_window_view(arr,2*(win//2),axis=-1)
+    return windows[...,::step,:][...,:num,:]
+
+
+def range_diff_series(self,win,step,pairs=None,Rcoarse=None,r_uncertainty=None,
+        uncertainty='CR',chunk_size=256,fn_out=None):
+    """
+    Calculate the vertical motion between many pairs of bursts.
+
+    The bursts are compared as in range_diff, but all pairs are done by the
+    same vectorized engine. The window sums of each burst are computed once
+    and reused for every pair it is part of, so only the cross term is
+    computed per pair.
+
+    Parameters
+    ---------
+    self: class
+        data object, after apres_range. Bursts with several chirps are
+        averaged over their chirps first (as stacking(cnum) would).
+    win: int
+        window size over which to do the correlation coefficient calculation
+    step: int
+        step size for the window to move between calculations
+    pairs: array; optional
+        (npairs, 2) burst indices (0-indexed) to compare, first then second.
+        Default is every consecutive pair, (0,1), (1,2), ...
+    Rcoarse: array; optional
+        if an external depth array is desired, input here
+    r_uncertainty: array; optional
+        (bnum, snum) noise phasor range uncertainty of each burst,
+        needed for uncertainty='noise_phasor'. The uncertainties of the two
+        bursts of each pair are summed, so a pair gives the same result as
+        range_diff with r_uncertainty=r_uncertainty[i1]+r_uncertainty[i2].
+    uncertainty: string;
+        default 'CR' Cramer-Rao bound as in Jordan et al. (2020)
+    chunk_size: int; optional
+        number of pairs to process at once
+    fn_out: str; optional
+        write the results to this h5 file as each chunk of pairs is done,
+        instead of keeping them in memory.
+
+    Output
+    --------
+    ds: array
+        depths at which the correlation coefficient is calculated
+    pairs: array
+        (npairs, 2) burst indices of each pair
+    phase_diff: array
+        (npairs, len(ds)) correlation coefficient between the bursts of each pair
+    range_diff: array
+        (npairs, len(ds)) vertical motion in meters
+    range_diff_unc: array
+        (npairs, len(ds)) uncertainty of the vertical motion in meters
+    The last three are None if fn_out is given; they are then in the datasets
+    co, r_diff and r_diff_unc of the file (along with ds, pairs, and the
+    decday of both bursts of each pair).
+    """
+
+    if self.flags.range == 0:
+        raise TypeError('The range filter has not been executed on this data class, do that before differencing.')
+    if uncertainty not in ['CR','noise_phasor']:
+        raise ValueError("uncertainty must be 'CR' or 'noise_phasor'")
+    if uncertainty == 'noise_phasor' and r_uncertainty is None:
+        raise ValueError('r_uncertainty is needed for the noise_phasor uncertainty')
+
+    if self.cnum == 1:
+        acqs = self.data[:,0,:]
+    else:
+        acqs = np.mean(self.data,axis=1)
+
+    if pairs is None:
+        pairs = np.column_stack((np.arange(self.bnum-1),np.arange(1,self.bnum)))
+    pairs = np.asarray(pairs,dtype=int).reshape(-1,2)
+    npairs = len(pairs)
+
+    idxs = np.arange(win//2,(acqs.shape[-1]-win//2),step)
+    nwin = len(idxs)
+    n = 2*(win//2)
+    if Rcoarse is not None:
+        ds = Rcoarse[idxs]
+    else:
+        ds = self.Rcoarse[idxs]
+
+    # window sums of every burst, shared by all the pairs it is in
+    s, ss = _window_moments(acqs,win,step,nwin)
+
+    if fn_out is not None:
+        fout = h5py.File(fn_out,'w')
+        grp = fout.create_group('range_diff')
+        grp.attrs['win'] = win
+        grp.attrs['step'] = step
+        grp.create_dataset('ds',data=ds)
+        grp.create_dataset('pairs',data=pairs)
+        grp.create_dataset('decday',data=np.asarray(self.decday)[pairs])
+        chunks = (max(1,min(chunk_size,npairs)),max(1,nwin))
+        co = grp.create_dataset('co',(npairs,nwin),dtype=np.result_type(acqs.dtype,np.complex64),chunks=chunks)
+        r_diff = grp.create_dataset('r_diff',(npairs,nwin),dtype=np.result_type(acqs.real.dtype,np.float32),chunks=chunks)
+        r_diff_unc = grp.create_dataset('r_diff_unc',(npairs,nwin),dtype=r_diff.dtype,chunks=chunks)
+    else:
+        fout = None
+        co = np.empty((npairs,nwin),dtype=np.result_type(acqs.dtype,np.complex64))
+        r_diff = np.empty((npairs,nwin),dtype=np.result_type(acqs.real.dtype,np.float32))
+        r_diff_unc = np.empty_like(r_diff)
+
+    try:
+        for ip in range(0,npairs,chunk_size):
+            chunk = slice(ip,min(ip+chunk_size,npairs))
+            i1 = pairs[chunk,0]
+            i2 = pairs[chunk,1]
+
+            s21 = _window_sum(acqs[i2]*np.conj(acqs[i1]),win,step,nwin)
+            co_chunk = _coherence(s[i1],ss[i1],s[i2],ss[i2],s21,n)
+
+            # convert the phase offset to a distance vector
+            r_diff_chunk = phase2range(np.angle(co_chunk),
+                    self.header.lambdac,
+                    ds,
+                    self.header.chirp_grad,
+                    self.header.ci)
+
+            if uncertainty == 'CR':
+                # Error from Cramer-Rao bound, Jordan et al. (2020) Ann. Glac. eq. (5)
+                sigma = (1./abs(co_chunk))*np.sqrt((1.-abs(co_chunk)**2.)/(2.*win))
+                r_diff_unc_chunk = phase2range(sigma,
+                        self.header.lambdac,
+                        ds,
+                        self.header.chirp_grad,
+                        self.header.ci)
+            else:
+                # Uncertainty from Noise Phasor as in Kingslake et al. (2014), summed for both bursts
+                r_unc = np.asarray(r_uncertainty)[i1] + np.asarray(r_uncertainty)[i2]
+                r_diff_unc_chunk = np.nanmean(_sliding_windows(r_unc,win,step,nwin),axis=-1)
+
+            co[chunk] = co_chunk
+            r_diff[chunk] = r_diff_chunk
+            r_diff_unc[chunk] = r_diff_unc_chunk
+    finally:
+        if fout is not None:
+            fout.close()
+
+    if fn_out is not None:
+        return ds, pairs, None, None, None
+    return ds, pairs, co, r_diff, r_diff_unc
+
+
+def stacking(self,num_chirps=None,by=None,time_window=None):
     """
     Stack traces/chirps together to beat down the noise.
 
@@ -295,24 +646,165 @@ def stacking(self,num_chirps=None):
     ---------
     num_chirps: int
         number of chirps to average over
+    by: str; optional
+        stack the chirps of each burst by group instead,
+        'attenuator' gives one chirp per attenuator setting,
+        'setting' one per attenuator/antenna setting (i.e. the sub-bursts are averaged),
+        'subburst' one per sub-burst (the settings within each sub-burst are averaged).
+        Chirps are taken to cycle through the attenuators fastest, then the antennas,
+        then the sub-bursts.
+    time_window: float; optional
+        stack consecutive bursts into bins of this length (days), e.g. 15./1440.
+        for 15 minutes. Can be combined with by.
+
+    The number of original chirps behind each stacked chirp is kept in
+    self.stack_count (bnum x cnum), and later stacks are weighted by it so
+    they still give the mean of the original chirps.
     """
 
+    if by is not None or time_window is not None:
+        if by is not None:
+            _stack_chirp_groups(self,by)
+        if time_window is not None:
+            _stack_time_bins(self,time_window)
+        self.flags.stack = int(np.max(self.stack_count))
+        return
+
     if num_chirps == None:
         num_chirps = self.cnum*self.bnum
 
     num_chirps = int(num_chirps)
+    # weights in the real type of the data, so single precision data stay single
+    weights = _stack_weights(self,self.data.real.dtype)
 
     if num_chirps == self.cnum:
-        self.data = np.reshape(np.mean(self.data,axis=1),(self.bnum,1,self.snum))
+        if weights is None:
+            self.data = np.reshape(np.mean(self.data,axis=1),(self.bnum,1,self.snum))
+        else:
+            self.data = np.reshape(np.sum(self.data*weights[...,None],axis=1)/np.sum(weights,axis=1,keepdims=True),
+                    (self.bnum,1,self.snum))
+        self.stack_count = np.sum(_stack_count(self),axis=1,keepdims=True)
         self.cnum = 1
     else:
         # reshape to jump across bursts
         data_hold = np.reshape(self.data,(1,self.cnum*self.bnum,self.snum))
         # take only the first set of chirps
         data_hold = data_hold[:,:num_chirps,:]
-
-        self.data = np.array([np.mean(data_hold,axis=1)])
+        counts = np.reshape(_stack_count(self),(1,self.cnum*self.bnum))[:,:num_chirps]
+
+        if weights is None:
+            self.data = np.array([np.mean(data_hold,axis=1)])
+        else:
+            weights = np.reshape(weights,(1,self.cnum*self.bnum))[:,:num_chirps]
+            self.data = np.array([np.sum(data_hold*weights[...,None],axis=1)/np.sum(weights)])
+        self.stack_count = np.sum(counts,keepdims=True)
         self.bnum = 1
         self.cnum = 1
 
     self.flags.stack = num_chirps
+
+
+def _stack_count(self):
+    """Chirps behind each chirp of the data, (bnum, cnum); ones if the data are unstacked."""
+    if getattr(self,'stack_count',None) is None:
+        return np.ones((self.bnum,self.cnum),dtype=int)
+    return np.reshape(self.stack_count,(self.bnum,self.cnum))
+
+
+def _stack_weights(self,dtype):
+    """Weights (of type dtype) for a stack, or None if every chirp counts once (a plain mean)."""
+    counts = _stack_count(self)
+    if np.all(counts == 1):
+        return None
+    return counts.astype(dtype)
+
+
+def _per_chirp(self,attr):
+    """A chirp attribute as (bnum, cnum), or None if it does not have one value per chirp."""
+    val = getattr(self,attr,None)
+    if val is None or np.size(val) != self.bnum*self.cnum:
+        return None
+    return np.reshape(val,(self.bnum,self.cnum))
+
+
+def _stack_chirp_groups(self,by):
+    """Average the chirps of each burst by attenuator, setting, or sub-burst."""
+    n_subbursts = getattr(self,'n_subbursts',None)
+    n_attenuators = getattr(self.header,'n_attenuators',None)
+    if by == 'attenuator':
+        if not n_attenuators or self.cnum % n_attenuators != 0:
+            raise TypeError('Need the number of attenuators (dividing cnum) to stack by attenuator.')
+        # chirp index = repeat*n_attenuators + attenuator
+        groups, axis = (self.cnum//n_attenuators,n_attenuators), 1
+    elif by in ['setting','subburst']:
+        if not n_subbursts or self.cnum % n_subbursts != 0:
+            raise TypeError('Need the number of sub-bursts (dividing cnum) to stack by {:s}.'.format(by))
+        # chirp index = subburst*settings_per_subburst + setting
+        groups = (n_subbursts,self.cnum//n_subbursts)
+        axis = 1 if by == 'setting' else 2
+    else:
+        raise ValueError("by must be 'attenuator', 'setting', or 'subburst'")
+
+    data = np.asarray(self.data)
+    counts = _stack_count(self)
+    weights = _stack_weights(self,data.real.dtype)
+    if weights is not None:
+        data = data*weights[...,None]
+
+    # sum over the group axis of a (bnum, groups..., snum) view, all groups in one pass
+    summed = np.sum(np.reshape(data,(self.bnum,)+groups+(self.snum,)),axis=axis)
+    counts = np.sum(np.reshape(counts,(self.bnum,)+groups),axis=axis)
+    self.data = summed/counts[...,None].astype(data.real.dtype)
+
+    # the first chirp of each group labels it, times are averaged
+    for attr in ['chirp_num','chirp_att']:
+        val = _per_chirp(self,attr)
+        if val is not None:
+            setattr(self,attr,np.take(np.reshape(val,(self.bnum,)+groups),0,axis=axis))
+    val = _per_chirp(self,'chirp_time')
+    if val is not None:
+        self.chirp_time = np.mean(np.reshape(val,(self.bnum,)+groups),axis=axis)
+
+    self.stack_count = counts
+    self.cnum = self.data.shape[1]
+
+
+def _stack_time_bins(self,time_window):
+    """Average consecutive bursts that fall in the same time_window (days) since the first burst."""
+    decday = np.reshape(self.decday,(self.bnum,))
+    order = np.argsort(decday,kind='stable')
+    if np.any(order != np.arange(self.bnum)):
+        raise TypeError('Bursts must be in time order to stack by time.')
+
+    # start of each bin, the bursts are summed between starts in one pass
+    bins = np.floor((decday-decday[0])/time_window)
+    starts = np.flatnonzero(np.hstack(([True],np.diff(bins) != 0)))
+    nbursts = np.diff(np.hstack((starts,self.bnum)))
+
+    data = np.asarray(self.data)
+    counts = _stack_count(self)
+    weights = _stack_weights(self,data.real.dtype)
+    if weights is not None:
+        data = data*weights[...,None]
+    counts = np.add.reduceat(counts,starts,axis=0)
+    self.data = np.add.reduceat(data,starts,axis=0)/counts[...,None].astype(data.real.dtype)
+
+    # per-burst values are averaged, chirp labels come from the first burst in each bin
+    self.decday = np.add.reduceat(decday,starts)/nbursts
+    val = _per_chirp(self,'chirp_time')
+    if val is not None:
+        self.chirp_time = np.add.reduceat(val,starts,axis=0)/nbursts[:,None]
+    for attr in ['chirp_num','chirp_att']:
+        val = _per_chirp(self,attr)
+        if val is not None:
+            setattr(self,attr,val[starts])
+    for attr in ['temperature1','temperature2','battery_voltage']:
+        val = getattr(self,attr,None)
+        if val is not None and np.size(val) == self.bnum:
+            setattr(self,attr,np.add.reduceat(np.reshape(val,(self.bnum,)).astype(float),starts)/nbursts)
+    val = getattr(self,'time_stamp',None)
+    if val is not None and np.size(val) == self.bnum:
+        self.time_stamp = np.reshape(val,(self.bnum,))[starts]
+
+    self.stack_count = counts
+    self.bnum = self.data.shape[0]
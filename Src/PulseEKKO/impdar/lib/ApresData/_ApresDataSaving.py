@@ -17,20 +17,23 @@ import h5py
 from scipy.io import savemat
 from .ApresFlags import ApresFlags
 from .ApresHeader import ApresHeader
+from .ApresH5Store import cube_chunks, encode_time_stamp, PER_BURST_ATTRS
 
 
-def save(self, fn):
+def save(self, fn, **kwargs):
     """Save the radar data
 
     Parameters
     ----------
     fn: str
         Filename. Extension can be h5 or legacy mat.
+    kwargs:
+        chunks, compression, and compression_opts for h5 files (see save_h5)
     """
 
     ext = os.path.splitext(fn)[1]
     if ext in ['.h5', '.hdf5']:
-        return save_h5(self, fn)
+        return save_h5(self, fn, **kwargs)
     elif ext == '.mat':
         return save_mat(self, fn)
     else:
@@ -87,33 +90,69 @@ def save_mat(self, fn):
     savemat(fn, mat)
 
 
-def save_h5(self, fn):
+def save_h5(self, fn, chunks=None, compression=None, compression_opts=None):
     """Save the radar data
 
     Parameters
     ----------
     fn: str
         Filename. Should have a .h5 extension
+    chunks: tuple, optional
+        chunk shape for the (bnum, cnum, snum) cubes, see save_as_h5_group
+    compression: str, optional
+        h5py compression filter for the cubes, e.g. 'gzip' or 'lzf'
+    compression_opts: optional
+        options for the filter, e.g. the gzip level
     """
     with h5py.File(fn, 'w') as f:
-        save_as_h5_group(self, f, 'dat')
+        save_as_h5_group(self, f, 'dat', chunks=chunks, compression=compression,
+                         compression_opts=compression_opts)
 
 
-def save_as_h5_group(self, h5_file_descriptor, groupname='dat'):
+def save_as_h5_group(self, h5_file_descriptor, groupname='dat', chunks=None, compression=None,
+                     compression_opts=None, resizable=False):
     """Save to a group in h5 file (useful to group multiple datasets to one file
 
+    The (bnum, cnum, snum) cubes (data and Rfine) are stored chunked, by default
+    one chirp of one burst in blocks of range bins (ApresH5Store.cube_chunks), so
+    they can be read back in pieces (see ApresData(fn, lazy=True)).
+
     Parameters
     ----------
     h5_file_descriptor: open hdf5 file
         The file object to write to. Can also be a group (if data should be a subgroup).
     groupname: str, optional
         The name this (sub)group should have.
+    chunks: tuple, optional
+        chunk shape for the cubes
+    compression: str, optional
+        h5py compression filter for the cubes, e.g. 'gzip' or 'lzf'
+    compression_opts: optional
+        options for the filter, e.g. the gzip level
+    resizable: bool, optional
+        store the per-burst values (PER_BURST_ATTRS) as datasets that can grow
+        along the burst axis, so that append_h5 can add bursts later
     """
+    def per_burst(attr, val):
+        return resizable and attr in PER_BURST_ATTRS and hasattr(val, 'shape') and \
+            len(val.shape) > 0 and val.shape[0] == self.bnum
+
+    def create_dataset(attr, val, dtype):
+        kwargs = {}
+        if per_burst(attr, val):
+            kwargs['maxshape'] = (None, ) + tuple(val.shape[1:])
+            kwargs['chunks'] = True
+        if len(val.shape) == 3:
+            kwargs['chunks'] = cube_chunks(val.shape, chunks)
+            kwargs['compression'] = compression
+            kwargs['compression_opts'] = compression_opts
+        grp.create_dataset(attr, data=val, dtype=dtype, **kwargs)
+
     grp = h5_file_descriptor.create_group(groupname)
     for attr in self.attrs_guaranteed:
         val = getattr(self, attr)
         if val is not None:
-            if hasattr(val, 'shape') and np.any([s != 1 for s in val.shape]):
+            if (hasattr(val, 'shape') and np.any([s != 1 for s in val.shape])) or per_burst(attr, val):
                 if val.dtype == 'O':
                     if hasattr(self, 'data_dtype') and self.data_dtype is not None:
                         dtype = self.data_dtype
@@ -121,7 +160,7 @@ def save_as_h5_group(self, h5_file_descriptor, groupname='dat'):
                         dtype = 'f'
                 else:
                     dtype = val.dtype
-                grp.create_dataset(attr, data=val, dtype=dtype)
+                create_dataset(attr, val, dtype)
             else:
                 grp.attrs.create(attr, val)
         else:
@@ -129,7 +168,7 @@ def save_as_h5_group(self, h5_file_descriptor, groupname='dat'):
     for attr in self.attrs_optional:
         if hasattr(self, attr) and getattr(self, attr) is not None:
             val = getattr(self, attr)
-            if hasattr(val, 'shape') and np.any([s != 1 for s in val.shape]):
+            if (hasattr(val, 'shape') and np.any([s != 1 for s in val.shape])) or per_burst(attr, val):
                 if val.dtype == 'O':
                     if hasattr(self, 'data_dtype') and self.data_dtype is not None:
                         dtype = self.data_dtype
@@ -140,10 +179,14 @@ def save_as_h5_group(self, h5_file_descriptor, groupname='dat'):
                     if attr == 'data':
                         dtype = data_dtype
                     dtype = val.dtype
-                grp.create_dataset(attr, data=val, dtype=dtype)
+                create_dataset(attr, val, dtype)
             else:
                 grp.attrs.create(attr, val)
 
+    time_stamp = getattr(self, 'time_stamp', None)
+    if time_stamp is not None:
+        create_dataset('time_stamp', encode_time_stamp(time_stamp), 'S19')
+
     if self.flags is not None:
         self.flags.write_h5(grp)
     else:
@@ -153,3 +196,64 @@ def save_as_h5_group(self, h5_file_descriptor, groupname='dat'):
         self.header.write_h5(grp)
     else:
         ApresHeader().write_h5(grp)
+
+
+def append_h5(self, fn, groupname='dat', chunks=None, compression=None, compression_opts=None):
+    """Add the bursts to an appendable h5 archive, creating it if needed
+
+    The first call writes the group as save_h5 does, but with the per-burst
+    values (data, chirp and time stamps, temperatures, ...) in datasets that
+    can grow. Later calls only extend those datasets, nothing already in the
+    file is rewritten. Keep raw and range-processed bursts in separate groups.
+    The archive is read with ApresData(fn, groupname=groupname) or, for a time
+    window, load_time_range(fn, start, stop, groupname).
+
+    Parameters
+    ----------
+    fn: str
+        Filename. Should have a .h5 extension
+    groupname: str, optional
+        group of the archive in the file, e.g. 'raw' or 'range'
+    chunks, compression, compression_opts:
+        layout of the cubes when the archive is created, see save_h5
+    """
+    if self.data is None or len(np.shape(self.data)) != 3:
+        raise ValueError('Need data shaped (bnum, cnum, snum) to append, e.g. from load_apres')
+
+    with h5py.File(fn, 'a') as f:
+        if groupname not in f:
+            save_as_h5_group(self, f, groupname, chunks=chunks, compression=compression,
+                             compression_opts=compression_opts, resizable=True)
+            return
+
+        grp = f[groupname]
+        if grp.attrs['snum'] != self.snum or grp.attrs['cnum'] != self.cnum:
+            raise ValueError('Need the same number of samples and chirps as the archive')
+        for attr in ['travel_time', 'Rcoarse']:
+            val = getattr(self, attr, None)
+            if attr in grp and (val is None or not np.allclose(grp[attr][:], val)):
+                raise ValueError('Need matching {:s} vectors'.format(attr))
+        if grp['ApresFlags'].attrs['range'] != self.flags.range:
+            raise ValueError('Cannot mix raw and range-processed bursts in one archive group')
+
+        # check everything first so that a failure leaves the archive untouched
+        n_old = int(grp.attrs['bnum'])
+        new = {}
+        for attr in PER_BURST_ATTRS:
+            val = getattr(self, attr, None)
+            if attr not in grp:
+                if val is not None and np.shape(val)[:1] == (self.bnum, ):
+                    raise ValueError('{:s} is not in the archive'.format(attr))
+                continue
+            dset = grp[attr]
+            if dset.maxshape[0] is not None:
+                raise ValueError('{:s} in this file cannot be appended to'.format(attr))
+            if val is None or tuple(np.shape(val)) != (self.bnum, ) + dset.shape[1:]:
+                raise ValueError('{:s} does not match the archive'.format(attr))
+            new[attr] = encode_time_stamp(val) if attr == 'time_stamp' else val
+
+        for attr, val in new.items():
+            dset = grp[attr]
+            dset.resize(n_old + self.bnum, axis=0)
+            dset[n_old:] = np.asarray(val)
+        grp.attrs['bnum'] = n_old + self.bnum
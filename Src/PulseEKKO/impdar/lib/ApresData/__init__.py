@@ -29,6 +29,7 @@ import h5py
 
 from .ApresFlags import ApresFlags
 from .ApresHeader import ApresHeader
+from .ApresH5Store import ApresH5Data, decode_time_stamp
 from ..ImpdarError import ImpdarError
 
 
@@ -37,6 +38,9 @@ class ApresData(object):
 
     We keep track of processing steps with the flags attribute.
     This base version's __init__ takes a filename of a .mat file in the old StODeep format to load.
+    With lazy=True, the (bnum, cnum, snum) cubes of an .h5 file are not read up front,
+    they are ApresH5Data views that read only the part that is indexed.
+    groupname selects the group of an .h5 file to read, e.g. one written by append_h5.
     """
     #: Attributes that every ApresData object should have and should not be None.
     attrs_guaranteed = ['data',
@@ -62,13 +66,18 @@ class ApresData(object):
                       'elev',
                       'temperature1',
                       'temperature2',
-                      'battery_voltage']
+                      'battery_voltage',
+                      'stack_count',
+                      'Rcoarse',
+                      'Rfine',
+                      'phiref']
 
-    from ._ApresDataProcessing import apres_range, phase_uncertainty, phase2range, range_diff, stacking
-    from ._ApresDataSaving import save
+    from ._ApresDataProcessing import apres_range, get_spec, phase_uncertainty, phase2range, range_diff, \
+        range_diff_series, stacking
+    from ._ApresDataSaving import save, append_h5
 
     # Now make some load/save methods that will work with the matlab format
-    def __init__(self, fn):
+    def __init__(self, fn, lazy=False, groupname='dat'):
         if fn is None:
             # Write these out so we can document them
             # Very basics
@@ -92,6 +101,8 @@ class ApresData(object):
             self.chirp_num = None  #: np.ndarray(cnum,) The 1-indexed number of the chirp
             self.chirp_att = None  #: np.ndarray(cnum,) Chirp attenuation settings
             self.chirp_time = None  #: np.ndarray(cnum,) Time at beginning of chirp (serial day)
+            #: np.ndarray(bnum x cnum) Optional. Number of raw chirps averaged into each chirp
+            self.stack_count = None
 
             # Sample-wise attributes
             #: np.ndarray(snum,) The two way travel time to each sample, in us
@@ -114,13 +125,18 @@ class ApresData(object):
 
         if os.path.splitext(fn)[1] == '.h5':
             with h5py.File(fn, 'r') as fin:
-                grp = fin['dat']
+                grp = fin[groupname]
                 for attr in grp.keys():
                     if attr in ['ApresFlags', 'ApresHeader']:
                         continue
+                    if lazy and grp[attr].ndim == 3:
+                        setattr(self, attr, ApresH5Data(fn, grp[attr].name))
+                        continue
                     val = grp[attr][:]
                     if isinstance(val, h5py.Empty):
                         val = None
+                    elif attr == 'time_stamp':
+                        val = decode_time_stamp(val)
                     setattr(self, attr, val)
                 for attr in grp.attrs.keys():
                     val = grp.attrs[attr]
@@ -155,9 +171,9 @@ class ApresData(object):
             self.data_dtype = self.data.dtype
             self.flags = ApresFlags()
             self.flags.from_matlab(mat['flags'])
+            self.header = ApresHeader()
 
         self.fn = fn
-        self.header = ApresHeader()
         self.check_attrs()
 
     def check_attrs(self):
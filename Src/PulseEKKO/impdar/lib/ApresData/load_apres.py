@@ -24,25 +24,82 @@ Sept 23 2019
 
 """
 import os
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from functools import partial
 
 import numpy as np
 from scipy.io import loadmat
 
 import datetime
-import re
+import h5py
 from . import ApresData
+from .ApresHeader import ApresHeader, parse_header
+from .ApresMemmap import ApresMemmap
+from .ApresH5Store import ApresH5Data, decode_time_stamp, PER_BURST_ATTRS
+from ._ApresDataProcessing import float_dtypes
 from ..ImpdarError import ImpdarError
 
 CHIRP_INTERVAL = 1.6384/(24.*3600.)
 
-
-def load_apres(fns_apres, burst=1, fs=40000, *args, **kwargs):
+#: Extension appended to the .dat file name for the burst index sidecar
+BURST_INDEX_EXT = '.idx.npz'
+
+#: One record per burst, see :func:`build_burst_index`
+BURST_INDEX_DTYPE = np.dtype([('offset', np.int64),
+                              ('data_offset', np.int64),
+                              ('header_len', np.int32),
+                              ('snum', np.int32),
+                              ('cnum', np.int32),
+                              ('n_subbursts', np.int32),
+                              ('n_attenuators', np.int32),
+                              ('average', np.int8),
+                              ('time_stamp', 'datetime64[s]')])
+
+# In-process cache of burst indices, keyed by absolute file name
+_BURST_INDEX_CACHE = {}
+
+#: Per-burst metadata returned by scan_apres (a file name column is added in front)
+SCAN_DTYPE = [('burst', np.int32),
+              ('time_stamp', 'datetime64[s]'),
+              ('snum', np.int32),
+              ('cnum', np.int32),
+              ('n_subbursts', np.int32),
+              ('n_attenuators', np.int32),
+              ('average', np.int8),
+              ('attenuator1', 'U32'),
+              ('af_gain', 'U32'),
+              ('tx_ant', 'U16'),
+              ('rx_ant', 'U16'),
+              ('f_lower', np.float64),
+              ('f_upper', np.float64),
+              ('period', np.float64),
+              ('fs', np.float64),
+              ('battery_voltage', np.float64),
+              ('temperature1', np.float64),
+              ('temperature2', np.float64),
+              ('latitude', np.float64),
+              ('longitude', np.float64),
+              ('rmb_issue', 'U8'),
+              ('vab_issue', 'U8'),
+              ('venom_issue', 'U8'),
+              ('sw_issue', 'U16')]
+
+
+def load_apres(fns_apres, burst=1, fs=40000, workers=None, precision=None, *args, **kwargs):
     """Load and concatenate all apres data from several files
 
     Parameters
     ----------
     fns_apres: list of file names for ApresData
         each loads object to concatenate
+    workers: int, optional
+        read and parse the files in a pool of this many processes.
+        Default (None or 1) loads them serially in this process.
+    precision: str, optional
+        'float64' or 'float32' for the voltages (see load_apres_single_file)
 
     Returns
     -------
@@ -50,42 +107,75 @@ def load_apres(fns_apres, burst=1, fs=40000, *args, **kwargs):
         A single, concatenated output.
     """
 
-    apres_data = []
-    for fn in fns_apres:
-        try:
-            apres_data.append(load_apres_single_file(
-                fn, burst=burst, fs=fs, *args, **kwargs))
-        except ImpdarError:
-            Warning('Cannot load file: '+fn)
-
-    from copy import deepcopy
-    out = deepcopy(apres_data[0])
-
-    for dat in apres_data[1:]:
-        if out.snum != dat.snum:
-            raise ValueError('Need the same number of vertical samples in each file')
-        if out.cnum != dat.cnum:
-            raise ValueError('Need the same number of chirps in each file')
-        if not np.all(out.travel_time == dat.travel_time):
-            raise ValueError('Need matching travel time vectors')
-        if not np.all(out.frequencies == dat.frequencies):
-            raise ValueError('Need matching frequency vectors')
-
-    out.data = np.vstack([[dat.data] for dat in apres_data])
-    out.chirp_num = np.vstack([[dat.chirp_num] for dat in apres_data])
-    out.chirp_att = np.vstack([[dat.chirp_att] for dat in apres_data])
-    out.chirp_time = np.vstack([[dat.chirp_time] for dat in apres_data])
-    out.time_stamp = np.hstack([dat.time_stamp for dat in apres_data])
-    out.temperature1 = np.hstack([dat.temperature1 for dat in apres_data])
-    out.temperature2 = np.hstack([dat.temperature2 for dat in apres_data])
-    out.battery_voltage = np.hstack(
-        [dat.battery_voltage for dat in apres_data])
+    load_one = partial(_load_apres_or_none, burst=burst, fs=fs, precision=precision, **kwargs)
+    if workers is not None and workers > 1 and len(fns_apres) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        apres_data = executor.map(load_one, fns_apres)
+    else:
+        executor = None
+        apres_data = map(load_one, fns_apres)
+
+    # Copy each file into one preallocated array as it arrives
+    out = None
+    n_loaded = 0
+    metadata = {attr: [] for attr in ['chirp_num', 'chirp_att', 'chirp_time', 'decday', 'time_stamp',
+                                      'temperature1', 'temperature2', 'battery_voltage']}
+    try:
+        for fn, dat in zip(fns_apres, apres_data):
+            if dat is None:
+                warnings.warn('Cannot load file: '+fn)
+                continue
+
+            if out is None:
+                data = dat.data
+                dat.data = None
+                out = deepcopy(dat)
+                out.data = np.empty((len(fns_apres), dat.cnum, dat.snum), dtype=data.dtype)
+                dat.data = data
+            else:
+                if out.snum != dat.snum:
+                    raise ValueError('Need the same number of vertical samples in each file')
+                if out.cnum != dat.cnum:
+                    raise ValueError('Need the same number of chirps in each file')
+                if not np.all(out.travel_time == dat.travel_time):
+                    raise ValueError('Need matching travel time vectors')
+                if not np.all(out.frequencies == dat.frequencies):
+                    raise ValueError('Need matching frequency vectors')
+
+            out.data[n_loaded] = dat.data
+            for attr, vals in metadata.items():
+                vals.append(getattr(dat, attr))
+            n_loaded += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if out is None:
+        raise ImpdarError('Could not load any of the files')
+
+    out.data = out.data[:n_loaded]
+    out.chirp_num = np.vstack(metadata['chirp_num'])
+    out.chirp_att = np.vstack(metadata['chirp_att'])
+    out.chirp_time = np.vstack(metadata['chirp_time'])
+    out.decday = np.hstack(metadata['decday'])
+    out.time_stamp = np.hstack(metadata['time_stamp'])
+    out.temperature1 = np.hstack(metadata['temperature1'])
+    out.temperature2 = np.hstack(metadata['temperature2'])
+    out.battery_voltage = np.hstack(metadata['battery_voltage'])
     out.bnum = np.shape(out.data)[0]
 
     return out
 
 
-def load_apres_single_file(fn_apres, burst=1, fs=40000, *args, **kwargs):
+def _load_apres_or_none(fn_apres, *args, **kwargs):
+    """Load a single file, returning None if it cannot be read (used by load_apres workers)."""
+    try:
+        return load_apres_single_file(fn_apres, *args, **kwargs)
+    except ImpdarError:
+        return None
+
+
+def load_apres_single_file(fn_apres, burst=1, fs=40000, mmap=False, precision=None, *args, **kwargs):
     """
     Load ApRES data
     This function calls the load_burst function below
@@ -98,6 +188,14 @@ def load_apres_single_file(fn_apres, burst=1, fs=40000, *args, **kwargs):
         number of bursts to load
     fs: int
         sampling frequency
+    mmap: bool
+        leave the samples on disk. For raw files data is then an ApresMemmap view
+        of the ADC counts that is scaled to volts when indexed; for .h5 files the
+        cubes are ApresH5Data views that are read in pieces as they are indexed.
+    precision: str, optional
+        'float64' or 'float32'. Raw files are converted to volts at this precision
+        (default float64); processed .mat/.h5 files are cast to it if it is given
+        and otherwise keep the stored precision.
 
     ### Original Matlab Notes ###
 
@@ -129,15 +227,16 @@ def load_apres_single_file(fn_apres, burst=1, fs=40000, *args, **kwargs):
             apres_data = ApresData(fn_apres)
         else:
             apres_data = load_BAS_mat(fn_apres)
-        return apres_data
+        return _cast_precision(apres_data, precision)
 
     elif ext == '.h5':
-        return ApresData(fn_apres)
+        return _cast_precision(ApresData(fn_apres, lazy=mmap), precision)
     else:
         # Load data and reshape array
         apres_data = ApresData(None)
         apres_data.header.update_parameters(fn_apres)
-        start_ind, end_ind = load_burst(apres_data, burst, fs)
+        start_ind, end_ind = load_burst(apres_data, burst, fs, mmap=mmap,
+                                        precision=precision or 'float64')
 
     # Extract just good chirp data from voltage record and rearrange into
     # matrix with one chirp per row
@@ -167,20 +266,15 @@ def load_apres_single_file(fn_apres, burst=1, fs=40000, *args, **kwargs):
             apres_data.header.lambdac = apres_data.header.ci/apres_data.header.fc
 
             # Load each chirp into a row
-            # preallocate array
-            data_load = np.zeros((apres_data.cnum, apres_data.snum))
+            # (chirps are contiguous, so this is a view rather than a copy)
+            apres_data.data = apres_data.data.reshape((apres_data.cnum, apres_data.snum))
             apres_data.chirp_num = np.arange(apres_data.cnum)
-            apres_data.chirp_att = np.zeros(
-                (apres_data.cnum)).astype(np.cdouble)
-            apres_data.chirp_time = np.zeros((apres_data.cnum))
+            # attenuator setting for each chirp (the attenuators cycle fastest)
+            apres_data.chirp_att = np.asarray(AttSet, dtype=np.cdouble)[
+                apres_data.chirp_num % len(AttSet)]
             # days TODO: why is this assigned directly?
             chirp_interval = 1.6384/(24.*3600.)
-            for chirp in range(apres_data.cnum):
-                data_load[chirp, :] = apres_data.data[start_ind[chirp]: end_ind[chirp]]
-                # attenuator setting for chirp
-                apres_data.chirp_att[chirp] = AttSet[chirp//apres_data.cnum]
-                apres_data.chirp_time[chirp] = apres_data.decday + chirp_interval*(chirp-1)
-            apres_data.data = data_load
+            apres_data.chirp_time = apres_data.decday + chirp_interval*(apres_data.chirp_num-1)
 
     # Create time and frequency stamp for samples
     # sampling times (rel to first)
@@ -193,7 +287,143 @@ def load_apres_single_file(fn_apres, burst=1, fs=40000, *args, **kwargs):
     return apres_data
 
 
-def load_burst(self, burst=1, fs=40000, max_header_len=2000, burst_pointer=0):
+def _cast_precision(apres_data, precision):
+    """Cast already-processed data (real or complex) to the requested precision."""
+    if precision is None:
+        return apres_data
+    real_dtype, complex_dtype = float_dtypes(precision)
+    for attr in ['data', 'spec', 'Rfine']:
+        val = getattr(apres_data, attr, None)
+        if val is not None:
+            dtype = complex_dtype if np.issubdtype(val.dtype, np.complexfloating) else real_dtype
+            if isinstance(val, ApresH5Data):
+                # still read lazily, just converted on the way out
+                val.dtype = np.dtype(dtype)
+            else:
+                setattr(apres_data, attr, np.asarray(val).astype(dtype, copy=False))
+    apres_data.data_dtype = apres_data.data.dtype
+    return apres_data
+
+
+def load_time_range(fn, start=None, stop=None, groupname='dat'):
+    """
+    Load only the bursts of an h5 archive that fall in a time range.
+
+    Only the selected rows of the per-burst datasets are read, so this stays
+    cheap on a long archive (see ApresData.append_h5).
+
+    Parameters
+    ---------
+    fn: string
+        h5 file name
+    start: float, datetime, or np.datetime64, optional
+        first time to include, as decday or a date. Default is the first burst.
+    stop: float, datetime, or np.datetime64, optional
+        include bursts before this time. Default is the last burst.
+    groupname: string
+        group of the archive in the file
+
+    Output
+    ---------
+    ApresData
+        the bursts with start <= decday < stop
+    """
+    apres_data = ApresData(None)
+    with h5py.File(fn, 'r') as fin:
+        grp = fin[groupname]
+        decday = grp['decday'][:].reshape(-1)
+        sel = np.ones(decday.shape, dtype=bool)
+        if start is not None:
+            sel &= decday >= _to_decday(start)
+        if stop is not None:
+            sel &= decday < _to_decday(stop)
+        idx = np.flatnonzero(sel)
+        if len(idx) > 0 and idx[-1] - idx[0] == len(idx) - 1:
+            # contiguous, one slice per dataset
+            idx = slice(idx[0], idx[-1] + 1)
+
+        for attr in grp.keys():
+            if attr in ['ApresFlags', 'ApresHeader']:
+                continue
+            dset = grp[attr]
+            if attr in PER_BURST_ATTRS and dset.ndim > 0 and dset.shape[0] == len(decday):
+                val = dset[idx]
+            else:
+                val = dset[()]
+            if attr == 'time_stamp':
+                val = decode_time_stamp(val)
+            setattr(apres_data, attr, val)
+        for attr in grp.attrs.keys():
+            val = grp.attrs[attr]
+            if isinstance(val, h5py.Empty):
+                val = None
+            setattr(apres_data, attr, val)
+        apres_data.flags.read_h5(grp)
+        apres_data.header.read_h5(grp)
+
+    apres_data.bnum = np.shape(apres_data.data)[0]
+    apres_data.fn = fn
+    apres_data.check_attrs()
+    return apres_data
+
+
+def _to_decday(time):
+    """A datetime or np.datetime64 as decday (numbers are taken to be decday already)."""
+    if isinstance(time, np.datetime64):
+        time = time.astype('datetime64[us]').astype(datetime.datetime)
+    if isinstance(time, datetime.datetime):
+        offset = time - datetime.datetime(1, 1, 1, 0, 0, 0)
+        return offset.days + offset.seconds/86400. + 377.
+    return float(time)
+
+
+def iter_bursts(fn_apres, start=1, stop=None, step=1, fs=40000, mmap=False, precision=None, *args, **kwargs):
+    """
+    Iterate over the bursts in a raw ApRES file, one burst at a time.
+
+    Each burst is yielded as its own ApresData object with data shaped
+    (1, cnum, snum), i.e. the same layout as load_apres, so it can go straight
+    into apres_range or stacking. Only one burst is held in memory at a time
+    (none at all with mmap=True, until the samples are indexed).
+
+    Parameters
+    ---------
+    fn_apres: string
+        file name
+    start: int
+        first burst to yield (1-indexed, like the burst argument to load_apres)
+    stop: int, optional
+        stop before this burst. Default is to run to the end of the file.
+    step: int
+        yield every step-th burst
+    fs: int
+        sampling frequency
+    mmap: bool
+        map the samples from disk rather than reading them (see load_burst)
+    precision: str, optional
+        'float64' (default) or 'float32' for the voltages
+
+    Yields
+    ---------
+    ApresData
+        a single-burst data object
+    """
+    n_bursts = len(load_burst_index(fn_apres))
+    if stop is None:
+        stop = n_bursts + 1
+    for burst in range(start, min(stop, n_bursts + 1), step):
+        apres_data = load_apres_single_file(fn_apres, burst=burst, fs=fs, mmap=mmap,
+                                            precision=precision, *args, **kwargs)
+        apres_data.data = apres_data.data.reshape((1, apres_data.cnum, apres_data.snum))
+        apres_data.chirp_num = apres_data.chirp_num[np.newaxis, :]
+        apres_data.chirp_att = apres_data.chirp_att[np.newaxis, :]
+        apres_data.chirp_time = apres_data.chirp_time[np.newaxis, :]
+        apres_data.bnum = 1
+        yield apres_data
+
+
+def load_burst(self, burst=1, fs=40000, max_header_len=2000, burst_pointer=0, mmap=False,
+               precision='float64'):
     """
     Load bursts from the apres acquisition.
     Normally, this should be called from the load_apres function.
@@ -207,7 +437,11 @@ def load_burst(self, burst=1, fs=40000, max_header_len=2000, burst_pointer=0):
     max_header_len: int
         maximum length to read for header (can be too long)
     burst_pointer: int
-        where to start reading the file for bursts
+        where to start reading the file for bursts (bursts are counted from here)
+    mmap: bool
+        map the samples read-only from disk (as an ApresMemmap) instead of reading them
+    precision: str
+        'float64' or 'float32', the type the counts are converted to in volts
 
     Output
     ---------
@@ -225,6 +459,21 @@ def load_burst(self, burst=1, fs=40000, max_header_len=2000, burst_pointer=0):
         raise TypeError('Loading functions have only been written for rmb5 data.\
                         Look back to the original Matlab scripts if you need to implement earlier formats.')
 
+    if burst < 1:
+        raise ValueError('Bursts are counted from 1, got {:d}'.format(burst))
+
+    # Look up the burst in the index rather than walking every header before it
+    index = load_burst_index(self.header.fn, max_header_len)
+    index = index[index['offset'] >= burst_pointer]
+    if burst > len(index):
+        # too few bursts in file
+        self.bnum = len(index)
+        self.flags.file_read_code = 'Burst' + \
+            str(burst) + 'not found in file' + self.header.fn
+        raise TypeError('Burst {:d} not found in file {:s}'.format(burst, self.header.fn))
+    burst_pointer = int(index['offset'][burst - 1])
+    data_pointer = int(index['data_offset'][burst - 1])
+
     try:
         fid = open(self.header.fn, 'rb')
     except FileNotFoundError:
@@ -232,145 +481,102 @@ def load_burst(self, burst=1, fs=40000, max_header_len=2000, burst_pointer=0):
         self.flags.file_read_code = 'Unable to read file' + self.header.fn
         raise ImpdarError('Cannot open file', self.header.fn)
 
-    # Get the total length of the file
-    fid.seek(0, 2)
-    file_len = fid.tell()
-    burst_count = 1
-
-    # --- Read bursts in a loop --- #
-    while burst_count <= burst and burst_pointer <= file_len - max_header_len:
-        # Go to burst pointer and read the header for the burst
-        fid.seek(burst_pointer)
-        self.header.read_header(self.header.fn, max_header_len)
-
-        try:
-            # Read header values
-            strings = ['N_ADC_SAMPLES=', 'NSubBursts=', 'Average=', 'nAttenuators=', 'Attenuator1=',
-                       'AFGain=', 'TxAnt=', 'RxAnt=']
-            output = np.empty((len(strings))).astype(str)
-            for i, string in enumerate(strings):
-                if string in self.header.header_string:
-                    search_start = self.header.header_string.find(string)
-                    search_end = self.header.header_string[search_start:].find(
-                        '\\')
-                    output[i] = self.header.header_string[search_start + len(string):
-                                                          search_end+search_start]
-
-            # Write header values to data object
-            self.snum = int(output[0])
-            self.n_subbursts = int(output[1])
-            self.average = int(output[2])
-            self.header.n_attenuators = int(output[3])
-            self.header.attenuator1 = np.array(output[4].split(',')).astype(int)[
-                :self.header.n_attenuators]
-            self.header.attenuator2 = np.array(output[5].split(',')).astype(int)[
-                :self.header.n_attenuators]
-            self.header.tx_ant = np.array(output[6].split(',')).astype(int)
-            self.header.rx_ant = np.array(output[7].split(',')).astype(int)
-
-            self.header.tx_ant = self.header.tx_ant[self.header.tx_ant == 1]
-            self.header.rx_ant = self.header.rx_ant[self.header.rx_ant == 1]
-
-            if self.average != 0:
-                self.cnum = 1
-            else:
-                self.cnum = self.n_subbursts*len(self.header.tx_ant) *\
-                    len(self.header.rx_ant)*self.header.n_attenuators
-
-            # End of burst
-            search_string = '*** End Header ***'
-            search_ind = self.header.header_string.find(search_string)
-            burst_pointer += search_ind + len(search_string)
+    # Read the header for this burst only
+    self.header.read_header(self.header.fn, int(index['header_len'][burst - 1]),
+                            burst_pointer=burst_pointer)
 
-        except ValueError:
-            # If the burst read is unsuccessful exit with an updated read code
-            self.flags.file_read_code = 'Corrupt header in burst' + \
-                str(burst_count) + 'for file' + self.header.fn
-            self.bnum = burst_count
-            raise ImpdarError('Burst Read Failed.')
-
-        # Move the burst pointer
-        if burst_count < burst and burst_pointer <= file_len - max_header_len:
-            if self.average != 0:
-                burst_pointer += self.cnum*self.snum*4
-            else:
-                burst_pointer += self.cnum*self.snum*2
+    fields = self.header.header_fields
+    try:
+        # Read header values
+        self.snum = int(fields['N_ADC_SAMPLES'])
+        self.n_subbursts = int(fields['NSubBursts'])
+        self.average = int(fields['Average'])
+        self.header.n_attenuators = int(fields['nAttenuators'])
+        self.header.attenuator1 = np.array(fields['Attenuator1'].split(',')).astype(int)[
+            :self.header.n_attenuators]
+        self.header.attenuator2 = np.array(fields['AFGain'].split(',')).astype(int)[
+            :self.header.n_attenuators]
+        self.header.tx_ant = np.array(fields['TxAnt'].split(',')).astype(int)
+        self.header.rx_ant = np.array(fields['RxAnt'].split(',')).astype(int)
+
+        self.header.tx_ant = self.header.tx_ant[self.header.tx_ant == 1]
+        self.header.rx_ant = self.header.rx_ant[self.header.rx_ant == 1]
+
+        if self.average != 0:
+            self.cnum = 1
+        else:
+            self.cnum = self.n_subbursts*len(self.header.tx_ant) *\
+                len(self.header.rx_ant)*self.header.n_attenuators
 
-        burst_count += 1
+    except (KeyError, ValueError):
+        # If the burst read is unsuccessful exit with an updated read code
+        self.flags.file_read_code = 'Corrupt header in burst' + \
+            str(burst) + 'for file' + self.header.fn
+        self.bnum = burst
+        fid.close()
+        raise ImpdarError('Burst Read Failed.')
 
     # --- Get remaining information from burst header --- #
 
-    # Look for a few different strings and save output
-    strings = ['Time stamp=', 'Temp1=', 'Temp2=', 'BatteryVoltage=']
-    output = []
-    for i, string in enumerate(strings):
-        if string in self.header.header_string:
-            search_start = [m.start() for m in re.finditer(
-                string, self.header.header_string)]
-            search_end = [self.header.header_string[ind:].find(
-                '\\') for ind in search_start]
-            out = [self.header.header_string[search_start[i] + len(string):
-                                             search_end[i]+search_start[i]]
-                   for i in range(len(search_start))]
-            output.append(out)
-
-    if 'Time stamp' not in self.header.header_string:
+    if 'Time stamp' not in fields:
         self.flags.file_read_code = 'Burst' + \
             str(self.bnum) + 'not found in file' + self.header.fn
     else:
         self.time_stamp = np.array([datetime.datetime.strptime(
-            str_time, '%Y-%m-%d %H:%M:%S') for str_time in output[0]])
+            fields['Time stamp'], '%Y-%m-%d %H:%M:%S')])
         timezero = datetime.datetime(1, 1, 1, 0, 0, 0)
         day_offset = self.time_stamp - timezero
         self.decday = np.array(
-            [offset.days for offset in day_offset]) + 377.  # Matlab compatable
+            [offset.days + offset.seconds/86400. for offset in day_offset]) + 377.  # Matlab compatable
 
-    self.temperature1 = np.array(output[1]).astype(float)
-    self.temperature2 = np.array(output[2]).astype(float)
-    self.battery_voltage = np.array(output[3]).astype(float)
+    self.temperature1 = np.array([fields['Temp1']]).astype(float)
+    self.temperature2 = np.array([fields['Temp2']]).astype(float)
+    self.battery_voltage = np.array([fields['BatteryVoltage']]).astype(float)
 
     # --- Read in the actual data --- #
 
-    # Go to the end of the header
-    end_byte = b'*** End Header ***'
-    data_ind = fid.read(max_header_len).rfind(end_byte) + len(end_byte)
-    fid.seek(data_ind)
-
-    # Only if all the bursts were read
-    if burst_count != burst+1:
-        # too few bursts in file
-        self.flags.file_read_code = 'Burst' + \
-            str(self.bnum) + 'not found in file' + self.header.fn
-        self.bnum = burst_count - 1
-        raise TypeError('Burst {:d} not found in file {:s}'.format(str(self.bnum), self.header.fn))
+    real_dtype = float_dtypes(precision)[0]
+
+    # Volts per ADC count
+    scale = 2.5/2**16.
+    if self.average == 2:
+        scale /= (self.n_subbursts*self.header.n_attenuators)
+
+    if mmap:
+        fid.close()
+        if self.average == 1:
+            raise ImpdarError('Memory mapping is only implemented for Average=0 or Average=2')
+        dtype = '<u4' if self.average == 2 else '<u2'
+        raw = np.memmap(self.header.fn, dtype=dtype, mode='r', offset=data_pointer,
+                        shape=(self.cnum*self.snum,))
+        self.data = ApresMemmap(raw, scale, dtype=real_dtype)
     else:
+        # Go to the end of the header
+        fid.seek(data_pointer)
+
         # TODO: Check the other readers for average == 1 or average == 2
         if self.average == 2:
             self.data = np.fromfile(
                 fid, dtype='uint32', count=self.cnum*self.snum)
         elif self.average == 1:
-            fid.seek(burst_pointer+1)
+            fid.seek(data_pointer+1)
             self.data = np.fromfile(
                 fid, dtype='float4', count=self.cnum*self.snum)
         else:
             self.data = np.fromfile(
                 fid, dtype='uint16', count=self.cnum*self.snum)
+        fid.close()
 
-        if fid.tell()-(burst_pointer-1) < self.cnum*self.snum:
+        if len(self.data) < self.cnum*self.snum:
             self.flags.file_read_code = 'Corrupt header in burst' + \
-                str(burst_count) + 'for file' + self.header.fn
+                str(burst) + 'for file' + self.header.fn
 
-        self.data[self.data < 0] = self.data[self.data < 0] + 2**16.
-        self.data = self.data.astype(float) * 2.5/2**16.
-
-        if self.average == 2:
-            self.data /= (self.n_subbursts*self.header.n_attenuators)
-
-        start_ind = np.transpose(np.arange(0, self.snum*self.cnum, self.snum))
-        end_ind = start_ind + self.snum
-        self.bnum = burst
+        # single conversion to volts (the counts are unsigned, so no sign fix-up is needed)
+        self.data = np.multiply(self.data, scale, dtype=real_dtype)
 
-    fid.close()
+    start_ind = np.transpose(np.arange(0, self.snum*self.cnum, self.snum))
+    end_ind = start_ind + self.snum
+    self.bnum = burst
 
     # Clean temperature record (wrong data type?)
     self.temperature1[self.temperature1 > 300] -= 512
@@ -381,6 +587,268 @@ def load_burst(self, burst=1, fs=40000, max_header_len=2000, burst_pointer=0):
     return start_ind, end_ind
 
 
+def build_burst_index(fn_apres, max_header_len=2000):
+    """
+    Walk the headers of an ApRES file once and record where each burst lives.
+
+    Parameters
+    ---------
+    fn_apres: string
+        file name
+    max_header_len: int
+        maximum length to read for header (can be too long)
+
+    Output
+    ---------
+    index: np.ndarray
+        structured array (see BURST_INDEX_DTYPE) with one record per complete burst
+    """
+    end_byte = b'*** End Header ***'
+    records = []
+    with open(fn_apres, 'rb') as fid:
+        fid.seek(0, 2)
+        file_len = fid.tell()
+        burst_pointer = 0
+        while burst_pointer < file_len:
+            fid.seek(burst_pointer)
+            header = fid.read(max_header_len)
+            header_len = header.find(end_byte)
+            if header_len == -1:
+                # trailing bytes or a truncated header
+                break
+            header_len += len(end_byte)
+            fields = parse_header(header[:header_len])
+
+            try:
+                snum = int(fields['N_ADC_SAMPLES'])
+                n_subbursts = int(fields['NSubBursts'])
+                average = int(fields['Average'])
+                n_attenuators = int(fields['nAttenuators'])
+                tx_ant = np.array(fields['TxAnt'].split(',')).astype(int)
+                rx_ant = np.array(fields['RxAnt'].split(',')).astype(int)
+                time_stamp = np.datetime64(datetime.datetime.strptime(
+                    fields['Time stamp'], '%Y-%m-%d %H:%M:%S'), 's')
+            except (KeyError, ValueError):
+                raise ImpdarError('Corrupt header in burst {:d} for file {:s}'.format(
+                    len(records) + 1, fn_apres))
+
+            if average != 0:
+                cnum = 1
+                bytes_per_sample = 4
+            else:
+                cnum = n_subbursts*np.sum(tx_ant == 1)*np.sum(rx_ant == 1)*n_attenuators
+                bytes_per_sample = 2
+
+            data_offset = burst_pointer + header_len
+            next_pointer = data_offset + cnum*snum*bytes_per_sample
+            if next_pointer > file_len:
+                # the last burst was cut short
+                break
+
+            records.append((burst_pointer, data_offset, header_len, snum, cnum,
+                            n_subbursts, n_attenuators, average, time_stamp))
+            burst_pointer = next_pointer
+
+    return np.array(records, dtype=BURST_INDEX_DTYPE)
+
+
+def load_burst_index(fn_apres, max_header_len=2000, sidecar=True):
+    """
+    Get the burst index for a file, building it only if needed.
+
+    The index is cached in memory and, if sidecar is True, in a file next to the
+    data (fn_apres + BURST_INDEX_EXT). Either copy is discarded if the size or
+    modification time of the data file has changed, and a sidecar that cannot be
+    read is rebuilt. Failure to write the sidecar (e.g. on a read-only archive)
+    is not an error.
+
+    Parameters
+    ---------
+    fn_apres: string
+        file name
+    max_header_len: int
+        maximum length to read for header (can be too long)
+    sidecar: bool
+        read and write the index file next to the data
+
+    Output
+    ---------
+    index: np.ndarray
+        structured array (see BURST_INDEX_DTYPE) with one record per complete burst
+    """
+    fn_apres = os.path.abspath(fn_apres)
+    try:
+        stat = os.stat(fn_apres)
+    except FileNotFoundError:
+        raise ImpdarError('Cannot open file', fn_apres)
+    key = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    if fn_apres in _BURST_INDEX_CACHE:
+        cached_key, index = _BURST_INDEX_CACHE[fn_apres]
+        if np.all(cached_key == key):
+            return index
+
+    fn_index = fn_apres + BURST_INDEX_EXT
+    index = None
+    if sidecar and os.path.exists(fn_index):
+        try:
+            with np.load(fn_index) as sidecar_file:
+                if np.all(sidecar_file['key'] == key) and \
+                        sidecar_file['index'].dtype == BURST_INDEX_DTYPE:
+                    index = sidecar_file['index']
+        except Exception:
+            # unreadable (e.g. truncated) sidecar: rebuild the index and overwrite it
+            index = None
+
+    if index is None:
+        index = build_burst_index(fn_apres, max_header_len)
+        if sidecar:
+            _write_burst_index(fn_index, key, index)
+
+    _BURST_INDEX_CACHE[fn_apres] = (key, index)
+    return index
+
+
+def _write_burst_index(fn_index, key, index):
+    """Write the sidecar through a temporary file, so a reader never sees half of one."""
+    try:
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(fn_index), suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            np.savez(fout, key=key, index=index)
+        os.replace(tmp_name, fn_index)
+    except OSError:
+        os.remove(tmp_name)
+
+
+def scan_apres(paths, recursive=True, max_header_len=2000, workers=None, as_dataframe=False):
+    """
+    Collect the metadata of every burst in a set of ApRES files without reading any samples.
+
+    Only the burst headers are read (the burst index is used to jump from one header
+    to the next), so a whole field season can be catalogued quickly.
+
+    Parameters
+    ---------
+    paths: string or list of strings
+        .dat files and/or directories to search for them
+    recursive: bool
+        search sub-directories too
+    max_header_len: int
+        maximum length to read for header (can be too long)
+    workers: int, optional
+        scan the files in a pool of this many processes
+    as_dataframe: bool
+        return a pandas DataFrame rather than a structured array (needs pandas)
+
+    Output
+    ---------
+    metadata: np.ndarray or pandas.DataFrame
+        one row per burst, columns 'fn' followed by those in SCAN_DTYPE
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    fns = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                fns.extend(os.path.join(root, fn) for fn in files if fn.lower().endswith('.dat'))
+                if not recursive:
+                    break
+        else:
+            fns.append(path)
+    fns = sorted(fns)
+
+    scan_one = partial(_scan_file, max_header_len=max_header_len)
+    if workers is not None and workers > 1 and len(fns) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            records = list(executor.map(scan_one, fns))
+    else:
+        records = list(map(scan_one, fns))
+
+    fn_len = max([len(fn) for fn in fns] + [1])
+    metadata = np.array([(fn, ) + record for fn, file_records in zip(fns, records) for record in file_records],
+                        dtype=[('fn', 'U{:d}'.format(fn_len))] + SCAN_DTYPE)
+
+    if as_dataframe:
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError('pandas is needed for as_dataframe=True')
+        return pd.DataFrame(metadata)
+    return metadata
+
+
+def _scan_file(fn_apres, max_header_len=2000):
+    """The SCAN_DTYPE records for every burst in one file (an empty list if it is unreadable)."""
+    try:
+        index = load_burst_index(fn_apres, max_header_len)
+    except ImpdarError:
+        warnings.warn('Cannot scan file: '+fn_apres)
+        return []
+
+    records = []
+    with open(fn_apres, 'rb') as fid:
+        for burst, entry in enumerate(index):
+            fid.seek(entry['offset'])
+            header_bytes = fid.read(entry['header_len'])
+
+            header = ApresHeader()
+            header.header_string = str(header_bytes)
+            header.header_fields = parse_header(header_bytes)
+            fields = header.header_fields
+            try:
+                header.update_parameters()
+                f_upper = header.f0 + header.chirp_length*header.chirp_grad/2./np.pi
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                f_upper = np.nan
+
+            n_attenuators = int(entry['n_attenuators'])
+            temperatures = []
+            for key in ['Temp1', 'Temp2']:
+                temperature = _float_field(fields, key)
+                # same clean-up as load_burst
+                if temperature > 300:
+                    temperature -= 512
+                temperatures.append(temperature)
+
+            records.append((burst + 1,
+                            entry['time_stamp'],
+                            entry['snum'],
+                            entry['cnum'],
+                            entry['n_subbursts'],
+                            n_attenuators,
+                            entry['average'],
+                            ','.join(fields.get('Attenuator1', '').split(',')[:n_attenuators]),
+                            ','.join(fields.get('AFGain', '').split(',')[:n_attenuators]),
+                            fields.get('TxAnt', ''),
+                            fields.get('RxAnt', ''),
+                            header.f0 if header.f0 is not None else np.nan,
+                            f_upper,
+                            header.chirp_length if header.chirp_length is not None else np.nan,
+                            header.fs,
+                            _float_field(fields, 'BatteryVoltage'),
+                            temperatures[0],
+                            temperatures[1],
+                            _float_field(fields, 'Latitude'),
+                            _float_field(fields, 'Longitude'),
+                            fields.get('RMB_Issue', ''),
+                            fields.get('VAB_Issue', ''),
+                            fields.get('Venom_Issue', ''),
+                            fields.get('SW_Issue', '')))
+    return records
+
+
+def _float_field(fields, key):
+    """A header value as a float, NaN if it is missing or blank."""
+    try:
+        return float(fields[key])
+    except (KeyError, ValueError):
+        return np.nan
+
+
 def load_BAS_mat(fn):
     mat = loadmat(fn)
 
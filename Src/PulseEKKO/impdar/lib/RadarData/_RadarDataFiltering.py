@@ -8,9 +8,14 @@
 """
 The class methods for filtering.
 """
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from scipy.signal import filtfilt, butter, tukey, cheby1, bessel, firwin, lfilter, wiener
-from .. import migrationlib
+from scipy.fft import next_fast_len
+from scipy.signal import filtfilt, sosfilt, sosfiltfilt, butter, tukey, cheby1, bessel, firwin, lfilter, wiener, \
+    zpk2sos, zpk2tf
+from .. import migrationlib, fftlib
 from ..ImpdarError import ImpdarError
 
 
@@ -56,31 +61,22 @@ def adaptivehfilt(self, window_size, *args, **kwargs):
     # taper average trace so it mostly affects only the upper layers in the data
     avg_trace_scale = (np.exp(-self.travel_time.flatten() * 0.05) / np.exp(-self.travel_time[0] * 0.05))
 
-    # preallocate array to fill with processed data
-    ahfilt_data = np.zeros_like(self.data, dtype=self.data.dtype)
-
-    # begin looping through data trace-by-trace
-    for i in range(int(self.tnum)):
-        # build a packet of window_size # of traces around the trace in question
-        if i <= window_size // 2:
-            scpacket = self.data[:, 0:window_size // 2 + i].copy()
-        elif i >= self.tnum - window_size // 2:
-            scpacket = self.data[:, int(self.tnum) - window_size:int(self.tnum)].copy()
-        else:
-            scpacket = self.data[:, i - window_size // 2 + 1:i + window_size // 2].copy()
-
-        # average the packet horizontally and double filter it (allows the
-        # program to maintain small horizontal artifacts that are likely real)
-        avg_trace_scan_low = filtfilt([.25, .25, .25, .25],
-                                      1,
-                                      np.mean(scpacket, axis=-1)
-                                      ).flatten() * avg_trace_scale.flatten()
-
-        # subtract the average trace off the data trace
-        # hfiltdata_scan_low[:, i] = hfiltdata_mass[:, i] - avg_trace_scan_low
-        ahfilt_data[:, i] = self.data[:, i].copy() - avg_trace_scan_low
-
-    self.data = ahfilt_data.astype(self.data.dtype)
+    # build a packet of window_size # of traces around each trace
+    tnum = int(self.tnum)
+    i = np.arange(tnum)
+    starts = np.where(i <= window_size // 2, 0,
+                      np.where(i >= tnum - window_size // 2, tnum - window_size, i - window_size // 2 + 1))
+    ends = np.where(i <= window_size // 2, window_size // 2 + i,
+                    np.where(i >= tnum - window_size // 2, tnum, i + window_size // 2))
+
+    # average each packet horizontally and double filter it (allows the
+    # program to maintain small horizontal artifacts that are likely real)
+    avg_traces = _moving_average(self.data, starts, ends)
+    avg_traces_low = filtfilt([.25, .25, .25, .25], 1, avg_traces, axis=0)
+    avg_traces_low *= avg_trace_scale.flatten()[:, np.newaxis]
+
+    # subtract the average trace off each data trace
+    self.data = (self.data - avg_traces_low).astype(self.data.dtype)
     print('Adaptive filtering complete')
 
     # set flags structure components
@@ -133,7 +129,7 @@ def horizontalfilt(self, ntr1, ntr2, *args, **kwargs):
     self.flags.hfilt = np.ones((2,))
 
 
-def highpass(self, wavelength):
+def highpass(self, wavelength, method='filtfilt', chunk_size=None):
     """High pass in the horizontal for a given wavelength.
 
     This only works if the data have constant trace spacing;
@@ -143,6 +139,10 @@ def highpass(self, wavelength):
     ----------
     wavelength: int
         The wavelength to pass, in meters.
+    method: str, optional
+        'filtfilt' (default) or 'fft'. See _horizontal_filter.
+    chunk_size: int, optional
+        Number of traces in each FFT for method='fft'. Default is the whole profile.
 
 
     Original StoDeep Documentation:
@@ -198,9 +198,9 @@ def highpass(self, wavelength):
     # Corner_Freq is used in the olaf_butter routine.
     corner_freq = high_corner_freq / nyquist_freq
 
-    b, a = butter(5, corner_freq, 'high')
+    zpk = butter(5, corner_freq, 'high', output='zpk')
 
-    self.data = filtfilt(b, a, self.data)
+    _horizontal_filter(self, zpk, method, chunk_size)
 
     # set flags structure components
     self.flags.hfilt = np.ones((2,))
@@ -209,7 +209,7 @@ def highpass(self, wavelength):
     print('Highpass filter complete.')
 
 
-def lowpass(self, wavelength):
+def lowpass(self, wavelength, method='filtfilt', chunk_size=None):
     """Low pass in the horizontal for a given wavelength.
 
     This only works if the data have constant trace spacing;
@@ -219,6 +219,10 @@ def lowpass(self, wavelength):
     ----------
     wavelength: int
         The wavelength to pass, in meters.
+    method: str, optional
+        'filtfilt' (default) or 'fft'. See _horizontal_filter.
+    chunk_size: int, optional
+        Number of traces in each FFT for method='fft'. Default is the whole profile.
 
 
     Original StoDeep Documentation:
@@ -274,9 +278,9 @@ def lowpass(self, wavelength):
     # Corner_Freq is used in the olaf_butter routine.
     corner_freq = high_corner_freq / nyquist_freq
 
-    b, a = butter(3, corner_freq, 'low')
+    zpk = butter(3, corner_freq, 'low', output='zpk')
 
-    self.data = filtfilt(b, a, self.data)
+    _horizontal_filter(self, zpk, method, chunk_size)
 
     # set flags structure components
     self.flags.hfilt = np.ones((2,))
@@ -285,7 +289,7 @@ def lowpass(self, wavelength):
     print('Lowpass filter complete.')
 
 
-def horizontal_band_pass(self, low, high):
+def horizontal_band_pass(self, low, high, method='filtfilt', chunk_size=None):
     """Bandpass in the horizontal for a given pair of wavelengths
 
     This only works if the data have constant trace spacing;
@@ -297,6 +301,10 @@ def horizontal_band_pass(self, low, high):
         The minimum wavelength to pass, in meters.
     high: float
         The maximum wavelength to pass, in meters.
+    method: str, optional
+        'filtfilt' (default) or 'fft'. See _horizontal_filter.
+    chunk_size: int, optional
+        Number of traces in each FFT for method='fft'. Default is the whole profile.
 
     """
     if self.flags.interp is None or not self.flags.interp[0]:
@@ -331,13 +339,14 @@ def horizontal_band_pass(self, low, high):
     high_corner_freq = high_corner_freq
     low_corner_freq = low_corner_freq
 
+    # the longest wavelength is the lowest frequency
     corner_freq = np.zeros((2,))
-    corner_freq[0] = low_corner_freq / nyquist_freq
-    corner_freq[1] = high_corner_freq / nyquist_freq
+    corner_freq[0] = high_corner_freq / nyquist_freq
+    corner_freq[1] = low_corner_freq / nyquist_freq
 
-    b, a = butter(5, corner_freq, 'bandpass')
+    zpk = butter(5, corner_freq, 'bandpass', output='zpk')
 
-    self.data = filtfilt(b, a, self.data, axis=1)
+    _horizontal_filter(self, zpk, method, chunk_size)
 
     # set flags structure components
     self.flags.hfilt = np.ones((2,))
@@ -346,6 +355,96 @@ def horizontal_band_pass(self, low, high):
     print('Highpass filter complete.')
 
 
+def _horizontal_filter(self, zpk, method='filtfilt', chunk_size=None, tol=1.0e-10):
+    """Zero-phase filter the data along the traces.
+
+    zpk is the (zeros, poles, gain) of the filter.
+    method='filtfilt' runs scipy.signal.filtfilt with the (b, a) form over the whole matrix.
+    method='fft' applies the same forward-backward filter with convolutions in the frequency
+    domain. The profile is extended at its ends as filtfilt does, and the start-up of the
+    forward and backward passes is reproduced: an odd reflection of padlen traces, the input
+    held before it, and the forward output held after it. With chunk_size, the traces are
+    transformed chunk_size at a time (overlap-save), so the memory needed does not grow with
+    the length of the profile.
+
+    The impulse response for 'fft' comes from the second-order sections, so it matches
+    sosfiltfilt to within the truncation tol of the impulse response. It differs from 'filtfilt'
+    by the rounding error of the (b, a) form, which is about 1e-7 of the largest output for
+    the usual corners but grows for narrow, low bands, where the (b, a) form becomes unstable.
+    """
+    if method not in ['filtfilt', 'fft']:
+        raise ValueError('method must be filtfilt or fft')
+    z, p, k = zpk
+    if method == 'filtfilt':
+        self.data = filtfilt(*zpk2tf(z, p, k), self.data)
+        return
+
+    tnum = self.data.shape[1]
+    # as filtfilt pads for the (b, a) form
+    padlen = 3 * (max(len(z), len(p)) + 1)
+    sos = zpk2sos(z, p, k)
+    if tnum <= padlen:
+        raise ValueError('The length of the input vector x must be greater than padlen, which is %d.' % padlen)
+
+    # impulse response of one pass, long enough to have decayed
+    max_len = 4 * (tnum + padlen)
+    nimp = 1024
+    while True:
+        impulse = np.zeros((nimp, ))
+        impulse[0] = 1.
+        h = sosfilt(sos, impulse)
+        tail = np.max(np.nonzero(np.abs(h) > tol * np.max(np.abs(h)))[0])
+        if tail < nimp // 2 or nimp >= max_len:
+            break
+        nimp *= 2
+    h = h[:tail + 1]
+
+    if chunk_size is None:
+        nfft = next_fast_len(tnum + 2 * tail)
+    else:
+        nfft = next_fast_len(max(int(chunk_size), 4 * tail + 1))
+    step = nfft - 2 * tail
+    h_f = fftlib.rfft(h, n=nfft)
+
+    # the backward pass starts from the forward output at the end of the extension, held
+    end = tnum + padlen
+    y_end = np.dot(_extended_traces(self.data, end - 1 - tail, end, padlen), h[::-1])
+
+    out = np.empty(self.data.shape, dtype=np.result_type(self.data.dtype, np.float64))
+    for start in range(0, tnum, step):
+        stop = min(start + step, tnum)
+        x_f = fftlib.rfft(_extended_traces(self.data, start - tail, start - tail + nfft, padlen), axis=1)
+        if stop + tail <= end:
+            # both passes at once, the backward one as a correlation
+            filtered = fftlib.irfft(x_f * np.abs(h_f) ** 2, n=nfft, axis=1)
+            out[:, start:stop] = filtered[:, tail:tail + stop - start]
+        else:
+            forward = fftlib.irfft(x_f * h_f, n=nfft, axis=1)[:, tail:2 * tail + stop - start]
+            forward[:, max(0, end - start):] = y_end[:, np.newaxis]
+            backward = fftlib.irfft(fftlib.rfft(forward, n=nfft, axis=1) * np.conj(h_f), n=nfft, axis=1)
+            out[:, start:stop] = backward[:, :stop - start]
+    self.data = out
+
+
+def _extended_traces(data, start, stop, padlen):
+    """Traces start to stop of the data extended past both ends.
+
+    Out to padlen traces past each end this is the odd reflection that filtfilt uses;
+    beyond that the last reflected trace is repeated.
+    """
+    tnum = data.shape[1]
+    ind = np.arange(start, stop)
+    left = ind < 0
+    right = ind >= tnum
+    src = np.clip(ind, 0, tnum - 1)
+    src[left] = np.minimum(-ind[left], padlen)
+    src[right] = tnum - 1 - np.minimum(ind[right] - (tnum - 1), padlen)
+    traces = data[:, src].astype(np.result_type(data.dtype, np.float64))
+    traces[:, left] = 2 * data[:, :1] - traces[:, left]
+    traces[:, right] = 2 * data[:, -1:] - traces[:, right]
+    return traces
+
+
 def winavg_hfilt(self, avg_win, taper='full', filtdepth=100):
     """Uses a moving window to find the average trace, then subtracts this from the data.
 
@@ -411,31 +510,51 @@ def winavg_hfilt(self, avg_win, taper='full', filtdepth=100):
     else:
         raise ValueError('Unrecognized taper. Options are full, pexp, or tukey')
 
-    hfiltdata = np.zeros_like(self.data, dtype=self.data.dtype)
     # set up ranges, create average, taper average, subtract average
+    i = np.arange(int(self.tnum))
+    # As opposed to StoDeep, don't wrap just cutoff for simplicity
+    range_start = np.maximum(i - ((avg_win - 1) // 2), 0)
+    range_end = np.minimum(i + ((avg_win - 1) // 2), int(self.tnum))
 
-    for i in range(int(self.tnum)):
-        range_start = i - ((avg_win - 1) // 2)
-        range_end = i + ((avg_win - 1) // 2)
+    # Create an average trace for every trace at once
+    avg_traces = _moving_average(self.data, range_start, range_end)
+    avg_traces *= exptaper[:, np.newaxis]
 
-        # As opposed to StoDeep, don't wrap just cutoff for simplicity
-        if range_start < 0:
-            range_start = 0
-        if range_end > self.tnum:
-            range_end = self.tnum
-        # Create an average trace
-        avg_trace = np.mean(self.data[:, range_start:range_end], axis=-1) * exptaper
-
-        # Subtract avg_trace from each trace
-        hfiltdata[:, i] = self.data[:, i] - avg_trace
-
-    self.data = hfiltdata.copy()
+    # Subtract avg_trace from each trace
+    self.data = (self.data - avg_traces).astype(self.data.dtype)
     self.flags.hfilt = np.zeros((2,))
     self.flags.hfilt[1] = 2
 
     print('Horizontal filter complete.')
 
 
+def _moving_average(data, starts, ends):
+    """Mean of data[:, starts[i]:ends[i]] for every trace i, in one pass.
+
+    The windows are differences of a cumulative sum along the traces, so the
+    cost does not depend on the window size. starts and ends are interpreted
+    like python slice bounds (negative values count from the end).
+    Empty windows give NaN, as np.mean would.
+    """
+    tnum = data.shape[1]
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+    starts = np.clip(np.where(starts < 0, starts + tnum, starts), 0, tnum)
+    ends = np.clip(np.where(ends < 0, ends + tnum, ends), 0, tnum)
+    counts = np.maximum(ends - starts, 0)
+    ends = np.maximum(ends, starts)
+
+    # csum[:, j] is the sum of the first j traces
+    csum = np.zeros((data.shape[0], tnum + 1), dtype=np.result_type(data.dtype, np.float64))
+    np.cumsum(data, axis=1, out=csum[:, 1:])
+
+    avg = csum[:, ends]
+    avg -= csum[:, starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg /= counts
+    return avg
+
+
 def hfilt(self, ftype='hfilt', bounds=None, window_size=None):
     """Horizontally filter the data.
 
@@ -469,6 +588,9 @@ def vertical_band_pass(self,
                        filttype='butter',
                        cheb_rp=5,
                        fir_window='hamming',
+                       dtype=np.float64,
+                       workers=1,
+                       chunk_size=512,
                        *args,
                        **kwargs):
     """Vertically bandpass the data
@@ -498,6 +620,17 @@ def vertical_band_pass(self,
     fir_window: str, optional
         The window type passed to scipy.signal.firwin.
         Only used if filttype=='fir'. Default is hamming'
+    dtype: np.dtype, optional
+        Precision the filter is computed in. np.float32 is faster and uses half the memory.
+        The data keep their own type either way. Default np.float64.
+    workers: int, optional
+        Number of threads filtering blocks of traces at once, capped at the number of cpus.
+        Default 1, i.e. the blocks are filtered in turn without a thread pool. scipy filters
+        each block on a single thread, so more workers only help on a machine with idle cores.
+        They are not coordinated with any BLAS or OpenMP threads elsewhere in the process, and
+        each holds a copy of its block.
+    chunk_size: int, optional
+        Number of traces in each block. Default 512.
     """
 
     # first determine the cut-off corner frequencies - expressed as a
@@ -519,24 +652,42 @@ def vertical_band_pass(self,
     print('Bandpassing from {:4.1f} to {:4.1f} MHz...'.format(low, high))
 
     # FIR operates a little differently, and cheb has rp arg,
-    # so we need to do each case separately
+    # so we need to do each case separately.
+    # The IIR filters are applied as second-order sections, which stay stable at high
+    # order and narrow bands where the transfer-function (b, a) form does not.
     if filttype.lower() in ['butter', 'butterworth']:
-        b, a = butter(order, corner_freq, 'bandpass')
-        self.data = filtfilt(b, a, self.data, axis=0).astype(self.data.dtype)
+        sos = butter(order, corner_freq, 'bandpass', output='sos')
     elif filttype.lower() in ['cheb', 'chebyshev']:
-        b, a = cheby1(order, cheb_rp, corner_freq, 'bandpass')
-        self.data = filtfilt(b, a, self.data, axis=0).astype(self.data.dtype)
+        sos = cheby1(order, cheb_rp, corner_freq, 'bandpass', output='sos')
     elif filttype.lower() == 'bessel':
-        b, a = bessel(order, corner_freq, 'bandpass')
-        self.data = filtfilt(b, a, self.data, axis=0).astype(self.data.dtype)
+        sos = bessel(order, corner_freq, 'bandpass', output='sos')
     elif filttype.lower() == 'fir':
-        taps = firwin(order + 1, corner_freq, pass_zero=False)
-        # I'm leaving the data past the filter--this is not filtfilt so we have a delay
-        self.data[:-order, :] = lfilter(taps, 1.0, self.data, axis=0
-                                        ).astype(self.data.dtype)[order:, :]
+        taps = firwin(order + 1, corner_freq, pass_zero=False).astype(dtype)
     else:
         raise ValueError('Filter type {:s} is not recognized'.format(filttype))
 
+    if filttype.lower() == 'fir':
+        def filt_block(cols):
+            # I'm leaving the data past the filter--this is not filtfilt so we have a delay
+            self.data[:-order, cols] = lfilter(taps, 1.0, self.data[:, cols].astype(dtype), axis=0)[order:, :]
+    else:
+        sos = sos.astype(dtype)
+        # pad as far as filtfilt would for the equivalent (b, a)
+        padlen = 3 * (2 * sos.shape[0] + 1)
+
+        def filt_block(cols):
+            self.data[:, cols] = sosfiltfilt(sos, self.data[:, cols].astype(dtype), axis=0, padlen=padlen)
+
+    # Every block reads and then overwrites only its own traces, so they can run in parallel
+    blocks = [slice(i, min(i + chunk_size, self.data.shape[1])) for i in range(0, self.data.shape[1], chunk_size)]
+    workers = max(1, min(workers or 1, os.cpu_count() or 1))
+    if workers == 1:
+        for block in blocks:
+            filt_block(block)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(filt_block, blocks))
+
     print('Bandpass filter complete.')
 
     # set flags structure components
@@ -12,7 +12,7 @@ Define processing steps for Radar Data. These are all instance methods.
 
 import numpy as np
 from scipy.interpolate import interp1d
-from scipy.optimize import minimize
+from scipy.ndimage import maximum_filter1d
 from ..permittivity_models import firn_permittivity
 from ..ImpdarError import ImpdarError
 
@@ -129,23 +129,17 @@ def nmo(self, ant_sep, uice=1.69e8, uair=3.0e8, const_firn_offset=None, rho_prof
 
     # --- Do the move-out correction --- #
 
-    # empty array to fill with new times
-    nmotime = np.zeros((len(self.travel_time)))
-
-    for i,t in enumerate(self.travel_time):
-        if rho_profile is None:
-            u_rms = uice
-        else:
-            # get RMS velocity used for correction
-            d = minimize(optimize_moveout_depth,.5*t*uice,args=(t,ant_sep,d_interp,u_interp),
-                         tol=1e-8,bounds=((0,0.5*t*uair),))['x'][0]
-            u_rms = np.sqrt(np.mean(u_interp[d_interp<d]**2.))
-        # get the upper leg of the trave_path triangle (direct arrival) from the antenna separation and the rms velocity
-        tsep_ice = 1e6*(ant_sep / u_rms)
-        # hypotenuese, adjust to 'transmit time' by adding the separation time
-        thyp = t+tsep_ice
-        # calculate the vertical two-way travel time
-        nmotime[i] = np.sqrt((thyp)**2. - tsep_ice**2.)
+    if rho_profile is None:
+        u_rms = uice
+    else:
+        # get RMS velocity used for correction
+        u_rms = moveout_rms_velocity(self.travel_time, ant_sep, d_interp, u_interp)
+    # get the upper leg of the trave_path triangle (direct arrival) from the antenna separation and the rms velocity
+    tsep_ice = 1e6*(ant_sep / u_rms)
+    # hypotenuese, adjust to 'transmit time' by adding the separation time
+    thyp = self.travel_time + tsep_ice
+    # calculate the vertical two-way travel time
+    nmotime = np.sqrt((thyp)**2. - tsep_ice**2.)
 
     # --- Cleanup --- #
 
@@ -171,31 +165,42 @@ def nmo(self, ant_sep, uice=1.69e8, uair=3.0e8, const_firn_offset=None, rho_prof
         self.flags.nmo[1] = ant_sep
 
 
-def optimize_moveout_depth(d_in, t, ant_sep, profile_depth, profile_u):
-    """Optimize depth in the nmo filter.
+def moveout_rms_velocity(travel_time, ant_sep, profile_depth, profile_u):
+    """RMS velocity above the reflector for each travel time, from a velocity profile.
 
-    In the case of variable velocity, we need to iterate on the depth
-    and rms velocity within this function until it converges.
+    The reflector depth d for a two-way time t satisfies t = 2 sqrt(d^2 + ant_sep^2) / u_rms(d),
+    where u_rms(d) is the RMS of the profile velocity above d. This is tabulated once on the
+    profile depths (extended with the deepest velocity as far as the latest time needs)
+    and the table is interpolated at every travel time.
 
     Parameters
     ----------
-    d_in: float
-        initial guess at the depth
-    t: float
-        time
+    travel_time: array
+        two-way travel times, in microseconds
     ant_sep: float
         antennae separation
     profile_depth: array
-        depths corresponding to input velocity profile
+        evenly spaced depths of the velocity profile
     profile_u: array
         velocity
+
+    Returns
+    -------
+    u_rms: np.ndarray
+        RMS velocity for each travel time
     """
-    args = np.argwhere(profile_depth<=d_in)
-    if len(args) == 0:
-        raise ValueError('Profile not shallow enough. Extend to cover top')
-    vels = profile_u[args][:,0]
-    u_rms = np.sqrt(np.mean(vels**2.))
-    return abs(np.sqrt((t/2.*u_rms)**2.-ant_sep**2.)-d_in)
+    depth = np.asarray(profile_depth, dtype=float)
+    u = np.asarray(profile_u, dtype=float)
+    d_need = 0.5 * np.max(travel_time) * 1.0e-6 * np.max(u)
+    if len(depth) > 1 and d_need > depth[-1]:
+        dz = depth[1] - depth[0]
+        n_ext = int(np.ceil((d_need - depth[-1]) / dz))
+        depth = np.append(depth, depth[-1] + dz * np.arange(1, n_ext + 1))
+        u = np.append(u, np.full((n_ext, ), u[-1]))
+
+    u_rms = np.sqrt(np.cumsum(u**2.) / np.arange(1, len(u) + 1))
+    table_t = np.maximum.accumulate(2.0e6 * np.sqrt(depth**2. + ant_sep**2.) / u_rms)
+    return np.interp(travel_time, table_t, u_rms)
 
 
 def traveltime_to_depth(self, profile_depth, profile_rho, c=3.0e8, permittivity_model=firn_permittivity):
@@ -395,7 +400,7 @@ def hcrop(self, lim, left_or_right='left', dimension='tnum'):
     self.tnum = self.data.shape[1]
 
 
-def restack(self, traces):
+def restack(self, traces, method='mean', weights=None, keep_tail=False):
     """Restack all relevant data to the given number of traces.
 
     This function just takes the average of the given number of traces.
@@ -403,18 +408,41 @@ def restack(self, traces):
     There are fancier ways to do this---
     if you have GPS, you probably want to restack to constant trace spacing instead.
 
+    The data and the 1-d variables (dist, lat, elev, etc.) are stacked the same way,
+    and trace_int becomes the total interval of each stack.
+
     Parameters
     ----------
     traces: int
         The (odd) number of traces to stack
+    method: str, optional
+        'mean' (default) or 'median' of the traces in each stack
+    weights: np.ndarray, optional
+        Weight of each input trace, for a weighted mean. Default is equal weights.
+    keep_tail: bool, optional
+        Stack the traces left over at the end (fewer than traces) into a last,
+        shorter stack rather than dropping them. Default False.
     """
+    if method not in ['mean', 'median']:
+        raise ValueError('method must be mean or median')
+    if weights is not None:
+        if method != 'mean':
+            raise ValueError('weights can only be used with the mean')
+        weights = np.asarray(weights, dtype=float)
+        if weights.shape != (self.tnum, ):
+            raise ValueError('Need one weight per trace')
     traces = int(traces)
     if traces % 2 == 0:
         print('Only will stack odd numbers of traces. Using {:d}'.format(int(traces + 1)))
         traces = traces + 1
-    tnum = int(np.floor(self.tnum / traces))
-    stack = np.zeros((self.snum, tnum))
-    trace_int = np.zeros((tnum, ))
+    nfull = int(np.floor(self.tnum / traces))
+    if keep_tail and self.tnum > nfull * traces:
+        used = self.tnum
+    else:
+        used = nfull * traces
+    starts = np.arange(0, used, traces)
+    tnum = len(starts)
+
     oned_restack_vars = ['dist',
                          'pressure',
                          'lat',
@@ -424,24 +452,49 @@ def restack(self, traces):
                          'elev',
                          'decday',
                          'trig']
-    oned_newdata = {key: np.zeros((tnum, )) if getattr(self, key) is not None else None for key in oned_restack_vars}
-    for j in range(tnum):
-        stack[:, j] = np.mean(self.data[:, j * traces:min((j + 1) * traces, self.data.shape[1])],
-                              axis=1)
-        # trace_int[j] = np.sum(self.trace_int[j * traces:min((j + 1) * traces, self.data.shape[1])])
-        for var, val in oned_newdata.items():
-            if val is not None:
-                val[j] = np.mean(getattr(self, var)[j * traces:
-                                                    min((j + 1) * traces, self.data.shape[1])])
+    # Stack all the 1-d variables that have a value per trace at once
+    oned_vars = [var for var in oned_restack_vars
+                 if isinstance(getattr(self, var), np.ndarray) and getattr(self, var).shape == (self.tnum, )]
+
+    self.data = _stack_traces(self.data, starts, used, traces, method, weights)
+    if len(oned_vars) > 0:
+        oned_data = _stack_traces(np.vstack([getattr(self, var) for var in oned_vars]),
+                                  starts, used, traces, method, weights)
+        for var, val in zip(oned_vars, oned_data):
+            setattr(self, var, val)
+
+    if isinstance(self.trace_int, np.ndarray) and self.trace_int.shape == (self.tnum, ):
+        self.trace_int = np.add.reduceat(self.trace_int[:used], starts, dtype=float) if tnum > 0 else np.zeros((0, ))
+    elif self.trace_int is not None and np.size(self.trace_int) == 1:
+        self.trace_int = self.trace_int * traces
+
     self.tnum = tnum
-    self.data = stack
     self.trace_num = np.arange(self.tnum).astype(int) + 1
-    self.trace_int = trace_int
-    for var, val in oned_newdata.items():
-        setattr(self, var, val)
     self.flags.restack = True
 
 
+def _stack_traces(arr, starts, used, traces, method, weights):
+    """Combine the columns of arr[:, :used] in groups beginning at starts.
+
+    All groups hold traces columns except possibly the last.
+    """
+    if len(starts) == 0:
+        return np.zeros((arr.shape[0], 0))
+    arr = arr[:, :used]
+    if method == 'median':
+        nfull = used // traces
+        out = np.zeros((arr.shape[0], len(starts)))
+        out[:, :nfull] = np.median(arr[:, :nfull * traces].reshape((arr.shape[0], nfull, traces)), axis=2)
+        if len(starts) > nfull:
+            out[:, nfull] = np.median(arr[:, nfull * traces:], axis=1)
+        return out
+    if weights is None:
+        counts = np.diff(np.append(starts, used))
+        return np.add.reduceat(arr, starts, axis=1, dtype=float) / counts
+    weights = weights[:used]
+    return np.add.reduceat(arr * weights, starts, axis=1, dtype=float) / np.add.reduceat(weights, starts)
+
+
 def rangegain(self, slope):
     """Apply a range gain.
 
@@ -450,23 +503,60 @@ def rangegain(self, slope):
     slope: float
         The slope of the linear range gain to be applied. Maybe try 1.0e-2?
     """
-    if isinstance(self.trig, (float, int, np.float, np.int64)):
+    if np.ndim(self.trig) == 0:
         gain = self.travel_time[int(self.trig) + 1:] * slope
         self.data[int(self.trig + 1):, :] *= np.atleast_2d(gain).transpose()
     else:
-        for i, trig in enumerate(self.trig):
-            gain = self.travel_time[int(trig) + 1:] * slope
-            self.data[int(trig) + 1:, i] *= gain
+        # the gain starts below the trigger of each trace. Only the rows between the
+        # shallowest and deepest trigger differ between traces.
+        gain = np.atleast_2d(self.travel_time * slope).transpose()
+        starts = np.clip(np.asarray(self.trig).astype(int) + 1, 0, self.snum)
+        band = slice(np.min(starts), np.max(starts))
+        self.data[band.stop:, :] *= gain[band.stop:]
+        self.data[band, :] *= np.where(_shift_mask(starts, band, self.snum), gain[band], 1.)
     self.flags.rgain = True
 
 
-def agc(self, window=50, scaling_factor=50):
+def _shift_mask(offsets, rows, snum):
+    """Mask of the rows (a slice) that hold data once each column of a snum-row array
+    is moved down by its offset, i.e. offset <= row < offset + snum."""
+    row = np.atleast_2d(np.arange(rows.start, rows.stop)).transpose() - np.asarray(offsets)
+    return (row >= 0) & (row < snum)
+
+
+def _shift_columns(data, offsets, nrows, dtype=np.float64, fill=np.nan):
+    """Move each column of data down by its offset, into a new nrows-row array.
+
+    The rows above and below each moved column (outside _shift_mask) are set to fill.
+    """
+    snum = data.shape[0]
+    offsets = np.asarray(offsets)
+    out = np.empty((nrows, data.shape[1]), dtype=dtype)
+    # Neighbouring traces usually share a shift, so each run of equal offsets is moved
+    # with one slice assignment rather than looping over every trace in Python. Plain
+    # slices also avoid building the full-size index array a fancy-index or
+    # take_along_axis gather would need.
+    bounds = np.r_[0, np.flatnonzero(np.diff(offsets)) + 1, len(offsets)]
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if start == stop:
+            continue
+        offset = offsets[start]
+        out[:offset, start:stop] = fill
+        out[offset:offset + snum, start:stop] = data[:, start:stop]
+        out[offset + snum:, start:stop] = fill
+    return out
+
+
+def agc(self, window=50, scaling_factor=50, mode='global', chunk_size=4096):
     """Try to do some automatic gain control
 
     This is from StoDeep--I'm not sure it is useful but it was easy to roll over so
     I'm going to keep it. I think you should have most of this gone with a bandpass,
     but whatever.
 
+    Each sample is divided by the largest amplitude within window // 2 samples of it
+    (samples i - window // 2 to i + window // 2 - 1), found with a running maximum.
+
     Parameters
     ----------
     window: int, optional
@@ -474,14 +564,33 @@ def agc(self, window=50, scaling_factor=50):
     scaling_factor: int, optional
         The scaling factor. This gets divided by the max amplitude when we rescale the input.
         Default 50.
+    mode: str, optional
+        'global' (default) uses the largest amplitude across all traces, so every trace
+        gets the same gain. 'trace' uses the largest amplitude of each trace alone.
+    chunk_size: int, optional
+        Number of traces to work on at once, to limit memory use. Default 4096.
     """
-    maxamp = np.zeros((self.snum,))
-    # In the for loop, old code indexed used range(window // 2). This did not make sense to me.
-    for i in range(self.snum):
-        maxamp[i] = np.max(np.abs(self.data[max(0, i - window // 2):
-                                            min(i + window // 2, self.snum), :]))
-    maxamp[maxamp == 0] = 1.0e-6
-    self.data *= (scaling_factor / np.atleast_2d(maxamp).transpose()).astype(self.data.dtype)
+    if mode not in ['global', 'trace']:
+        raise ValueError('mode must be global or trace')
+    if window // 2 < 1:
+        raise ValueError('window must be at least 2 samples')
+    # In the old loop, code indexed used range(window // 2). This did not make sense to me.
+    size = 2 * (window // 2)
+    chunks = [slice(i, min(i + chunk_size, self.tnum)) for i in range(0, self.tnum, chunk_size)]
+
+    if mode == 'global':
+        rowmax = np.zeros((self.snum,))
+        for chunk in chunks:
+            rowmax = np.maximum(rowmax, np.max(np.abs(self.data[:, chunk]), axis=1))
+        maxamp = maximum_filter1d(rowmax, size, mode='constant', cval=0.)
+        maxamp[maxamp == 0] = 1.0e-6
+        self.data *= (scaling_factor / np.atleast_2d(maxamp).transpose()).astype(self.data.dtype)
+    else:
+        for chunk in chunks:
+            maxamp = maximum_filter1d(np.abs(self.data[:, chunk]), size, axis=0, mode='constant', cval=0.,
+                                      output=np.float64)
+            maxamp[maxamp == 0] = 1.0e-6
+            self.data[:, chunk] *= (scaling_factor / maxamp).astype(self.data.dtype)
     self.flags.agc = True
 
 
@@ -563,7 +672,7 @@ def constant_space(self, spacing, min_movement=1.0e-2, show_nomove=False):
         self.flags.interp[1] = spacing
 
 
-def elev_correct(self, v_avg=1.69e8):
+def elev_correct(self, v_avg=1.69e8, dtype=np.float64, masked=False):
     """Move the surface down in the data array to account for surface elevation.
 
     NMO depth attribute must have been created before elev_correct is called.
@@ -580,6 +689,11 @@ def elev_correct(self, v_avg=1.69e8):
     v_avg: float, optional
         Average velocity. This is what will define the depth slices in the new data array.
         Default 1.69e8.
+    dtype: np.dtype, optional
+        Type of the corrected data. Default float64; float32 halves the memory.
+    masked: bool, optional
+        Return the data as a masked array, with the samples above the surface and below
+        the end of each trace masked, rather than filled with NaN. Default False.
 
     Raises
     ------
@@ -596,13 +710,14 @@ def elev_correct(self, v_avg=1.69e8):
     dz_avg = self.dt * (v_avg / 2.)
     max_samp = int(np.floor(max_diff / dz_avg))
 
-    data_old = self.data.copy()
-    self.data = np.zeros((data_old.shape[0] + max_samp, data_old.shape[1]))
-    self.data[:, :] = np.nan
-
-    for i in range(self.data.shape[1]):
-        left_ind = int(elev_diffs[i] // dz_avg)
-        self.data[left_ind: left_ind + data_old.shape[0], i] = data_old[:, i]
+    snum = self.data.shape[0]
+    left_inds = (elev_diffs // dz_avg).astype(int)
+    if masked:
+        mask = ~_shift_mask(left_inds, slice(0, snum + max_samp), snum)
+        self.data = np.ma.masked_array(_shift_columns(self.data, left_inds, snum + max_samp, dtype, 0),
+                                       mask=mask)
+    else:
+        self.data = _shift_columns(self.data, left_inds, snum + max_samp, dtype)
 
     self.elevation = np.hstack((np.arange(np.max(self.elev), np.min(self.elev), -dz_avg),
                                 np.min(self.elev) - self.nmo_depth))
@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Distributed under terms of the GNU GPL3 license.
+
+"""
+Pluggable FFT backend for range processing and migration
+
+Three backends are available:
+    numpy (default) plain np.fft, single threaded
+    scipy   scipy.fft, multithreaded with workers
+    pyfftw  pyFFTW builders; a plan is made once per transform size/dtype and reused
+
+The backend and worker count can be set with set_backend, or through the
+IMPDAR_FFT_BACKEND and IMPDAR_FFT_WORKERS environment variables.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from .ImpdarError import ImpdarError
+
+try:
+    import scipy.fft as scipy_fft
+    SCIPY_FFT = True
+except ImportError:
+    SCIPY_FFT = False
+
+try:
+    import pyfftw
+    import pyfftw.builders
+    PYFFTW = True
+except ImportError:
+    PYFFTW = False
+
+BACKENDS = ('numpy', 'scipy', 'pyfftw')
+
+# maximum number of pyfftw plans kept, least recently used are dropped first
+MAX_PLANS = 32
+
+_config = {'backend': 'numpy', 'workers': 1, 'planner_effort': 'FFTW_MEASURE'}
+_plans = OrderedDict()
+
+
+def set_backend(backend='numpy', workers=None, planner_effort=None):
+    """Select the library used for the FFTs.
+
+    Parameters
+    ----------
+    backend: str
+        'numpy', 'scipy', or 'pyfftw'
+    workers: int, optional
+        number of threads for the scipy and pyfftw backends.
+        -1 uses all cpus. Default is to leave the current setting.
+    planner_effort: str, optional
+        pyFFTW planner flag, e.g. 'FFTW_ESTIMATE' or 'FFTW_MEASURE'
+    """
+    if backend not in BACKENDS:
+        raise ValueError('FFT backend must be one of %s' % str(BACKENDS))
+    if backend == 'scipy' and not SCIPY_FFT:
+        raise ImpdarError('scipy.fft is not available, update scipy or use numpy')
+    if backend == 'pyfftw' and not PYFFTW:
+        raise ImpdarError('pyfftw is not installed')
+    if workers is not None:
+        workers = int(workers)
+        if workers == -1:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError('workers must be a positive integer or -1')
+        _config['workers'] = workers
+    if planner_effort is not None:
+        _config['planner_effort'] = planner_effort
+    _config['backend'] = backend
+    clear_plans()
+
+
+def get_backend():
+    """Return the (backend, workers) currently in use."""
+    return _config['backend'], _config['workers']
+
+
+def clear_plans():
+    """Drop all cached pyfftw plans."""
+    _plans.clear()
+
+
+def fft(a, n=None, axis=-1):
+    """One-dimensional discrete Fourier Transform, as np.fft.fft."""
+    return _transform('fft', a, n=n, axis=axis)
+
+
+def ifft(a, n=None, axis=-1):
+    """One-dimensional inverse discrete Fourier Transform, as np.fft.ifft."""
+    return _transform('ifft', a, n=n, axis=axis)
+
+
+def rfft(a, n=None, axis=-1):
+    """One-dimensional discrete Fourier Transform of real input, as np.fft.rfft."""
+    return _transform('rfft', a, n=n, axis=axis)
+
+
+def irfft(a, n=None, axis=-1):
+    """Inverse of rfft, as np.fft.irfft."""
+    return _transform('irfft', a, n=n, axis=axis)
+
+
+def fft2(a, s=None, axes=(-2, -1)):
+    """Two-dimensional discrete Fourier Transform, as np.fft.fft2."""
+    return _transform('fft2', a, s=s, axes=tuple(axes))
+
+
+def ifft2(a, s=None, axes=(-2, -1)):
+    """Two-dimensional inverse discrete Fourier Transform, as np.fft.ifft2."""
+    return _transform('ifft2', a, s=s, axes=tuple(axes))
+
+
+def _transform(name, a, **kwargs):
+    backend = _config['backend']
+    if backend == 'scipy':
+        return getattr(scipy_fft, name)(a, workers=_config['workers'], **kwargs)
+    elif backend == 'pyfftw':
+        a = np.asarray(a)
+        if name in ('rfft',) and np.iscomplexobj(a):
+            a = a.real
+        elif name in ('fft', 'ifft', 'fft2', 'ifft2', 'irfft') and not np.iscomplexobj(a):
+            a = a.astype(np.complex128)
+        plan = _get_plan(name, a, kwargs)
+        # the plan owns its output array, copy so the next call does not overwrite it
+        return plan(a).copy()
+    else:
+        return getattr(np.fft, name)(a, **kwargs)
+
+
+def _get_plan(name, a, kwargs):
+    key = (name, a.shape, a.dtype.str, tuple(sorted(kwargs.items())))
+    plan = _plans.get(key)
+    if plan is None:
+        template = pyfftw.empty_aligned(a.shape, dtype=a.dtype)
+        plan = getattr(pyfftw.builders, name)(template,
+                                              threads=_config['workers'],
+                                              planner_effort=_config['planner_effort'],
+                                              **kwargs)
+        _plans[key] = plan
+        if len(_plans) > MAX_PLANS:
+            _plans.popitem(last=False)
+    else:
+        _plans.move_to_end(key)
+    return plan
+
+
+def _set_from_environment():
+    backend = os.environ.get('IMPDAR_FFT_BACKEND', 'numpy').lower()
+    workers = os.environ.get('IMPDAR_FFT_WORKERS')
+    try:
+        set_backend(backend, workers=workers)
+    except (ValueError, ImpdarError):
+        _config['backend'] = 'numpy'
+
+
+_set_from_environment()
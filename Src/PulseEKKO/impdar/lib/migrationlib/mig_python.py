@@ -31,6 +31,8 @@ import time
 from scipy import sparse
 from scipy.interpolate import griddata, interp2d, interp1d
 
+from .. import fftlib
+
 
 def migrationKirchhoffLoop(data, migdata, tnum, snum, dist, zs, zs2, tt_sec, vel, gradD, max_travel_time, nearfield):
     # Loop through all traces
@@ -147,7 +149,7 @@ def migrationStolt(dat,vel=1.68e8,htaper=100,vtaper=1000):
     H,V = np.meshgrid(h,v)
     dat.data *= H*V
     # 2D Forward Fourier Transform to get data in frequency-wavenumber space, FK = D(kx,z=0,ws)
-    FK = np.fft.fft2(dat.data,(dat.snum,dat.tnum))[:dat.snum//2]
+    FK = fftlib.fft2(dat.data,(dat.snum,dat.tnum))[:dat.snum//2]
     # get the temporal frequencies
     ws = 2.*np.pi*np.fft.fftfreq(dat.snum, d=dat.dt)[:dat.snum//2]
     # get the horizontal wavenumbers
@@ -188,7 +190,7 @@ def migrationStolt(dat,vel=1.68e8,htaper=100,vtaper=1000):
     # the DC frequency should be 0.
     KK[0,0] = 0.+0j
     # 2D Inverse Fourier Transform to get back to distance spce, D(x,z,t=0)
-    dat.data = np.real(np.fft.ifft2(KK))
+    dat.data = np.real(fftlib.ifft2(KK))
     # Cut array to input matrix dimensions
     dat.data = dat.data[:dat.snum,:dat.tnum]
 
@@ -264,7 +266,7 @@ def migrationPhaseShift(dat,vel=1.69e8,vel_fn=None,htaper=100,vtaper=1000, **gen
     kx = 2.*np.pi*np.fft.fftfreq(dat.tnum,d=np.mean(trace_int))
     ws = 2.*np.pi*np.fft.fftfreq(nt,d=dat.dt)
     # 2D Forward Fourier Transform to get data in frequency-wavenumber space, FK = D(kx,z=0,ws)
-    FK = np.fft.fft2(dat.data,(nt,dat.tnum))
+    FK = fftlib.fft2(dat.data,(nt,dat.tnum))
     # Velocity structure from input
     if vel_fn is not None:
         try:
@@ -276,7 +278,7 @@ def migrationPhaseShift(dat,vel=1.69e8,vel_fn=None,htaper=100,vtaper=1000, **gen
     # Migration by phase shift, frequency-wavenumber (FKx) to time-wavenumber (TKx)
     TK = phaseShift(dat, vmig, vel, kx, ws, FK)
     # Transform from time-wavenumber (TKx) to time-space (TX) domain to get migrated section
-    dat.data = np.fft.ifft(TK).real
+    dat.data = fftlib.ifft(TK).real
     # print the total time
     print('')
     print('Phase-Shift Migration of %.0fx%.0f matrix complete in %.2f seconds'
@@ -462,7 +464,7 @@ def phaseShift(dat, vmig, vels_in, kx, ws, FK):
 
                 if hasattr(vmig[itau],"__len__"):
                     # inverse fourier tranform to frequency-space domain
-                    FFX = np.fft.ifft(FK[iw])
+                    FFX = fftlib.ifft(FK[iw])
 
                     ### Thin-lens term (Stoffa et al. 1990)
                     phase2 = 2. * ufg * w * dat.dt + 1. * vbg * w * dat.dt
@@ -475,7 +477,7 @@ def phaseShift(dat, vmig, vels_in, kx, ws, FK):
                     FFX_last = FFX
 
                     # Fourier transform back to frequency-wavenumber domain
-                    FK[iw] = np.fft.fft(FFX)
+                    FK[iw] = fftlib.fft(FFX)
 
                 # zero if outside domain
                 idx = coss <= (tau/dat.travel_time[-1]/1e6)**2.
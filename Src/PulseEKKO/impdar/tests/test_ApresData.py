@@ -0,0 +1,255 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Distributed under terms of the GNU GPL3 license.
+
+"""
+Tests of ApresData processing on small synthetic data
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.io import loadmat, savemat
+
+from impdar.lib.ApresData import ApresData, load_apres
+from impdar.tests.test_ApresProfile import write_raw
+
+
+def synthetic_apres(bnum=3, cnum=4, snum=200, dtype=np.complex128, seed=0):
+    """An ApresData object that looks range processed, filled with noise."""
+    rng = np.random.default_rng(seed)
+    dat = ApresData(None)
+    dat.bnum, dat.cnum, dat.snum = bnum, cnum, snum
+    dat.data = (rng.normal(size=(bnum, cnum, snum)) +
+                1j * rng.normal(size=(bnum, cnum, snum))).astype(dtype)
+    dat.data_dtype = dat.data.dtype
+    dat.decday = 738000. + np.arange(bnum) / 96.
+    dat.chirp_time = dat.decday[:, None] + np.arange(cnum)[None, :] / 86400.
+    dat.chirp_num = np.tile(np.arange(cnum), (bnum, 1))
+    dat.chirp_att = np.zeros((bnum, cnum))
+    dat.Rcoarse = np.arange(snum) * 0.2
+    dat.dt = 1. / 40000.
+    dat.travel_time = np.arange(snum) * dat.dt
+    dat.frequencies = 2.0e8 + np.arange(snum) * 1.0e4
+    dat.header.lambdac = 0.5608
+    dat.header.chirp_grad = 2. * np.pi * 2.e8
+    dat.header.ci = 1.6823e8
+    dat.flags.range = 1
+    return dat
+
+
+class TestRangeDiff(unittest.TestCase):
+
+    def test_window_longer_than_data(self):
+        dat = synthetic_apres(snum=20)
+        ds, co, r_diff, r_diff_unc = dat.range_diff(dat.data[0, 0], dat.data[1, 0], 40, 5)
+        self.assertEqual(len(ds), 0)
+        self.assertEqual(co.shape, (0, ))
+        self.assertEqual(r_diff.shape, (0, ))
+        self.assertEqual(r_diff_unc.shape, (0, ))
+
+        ds, co, r_diff, r_diff_unc = dat.range_diff(dat.data[0, 0], dat.data[1, 0], 40, 5,
+                                                    r_uncertainty=np.ones((20, )),
+                                                    uncertainty='noise_phasor')
+        self.assertEqual(r_diff_unc.shape, (0, ))
+
+    def test_noise_phasor_matches_series(self):
+        dat = synthetic_apres(cnum=1)
+        r_unc = np.random.default_rng(2).random((dat.bnum, dat.snum))
+        ds, pairs, co, r_diff, r_diff_unc = dat.range_diff_series(20, 5, r_uncertainty=r_unc,
+                                                                   uncertainty='noise_phasor')
+        for k, (i1, i2) in enumerate(pairs):
+            single = dat.range_diff(dat.data[i1, 0], dat.data[i2, 0], 20, 5,
+                                    r_uncertainty=r_unc[i1] + r_unc[i2], uncertainty='noise_phasor')
+            self.assertTrue(np.allclose(single[1], co[k]))
+            self.assertTrue(np.allclose(single[3], r_diff_unc[k]))
+
+    def test_window_longer_than_data_stack(self):
+        dat = synthetic_apres(snum=20)
+        ds, co, r_diff, r_diff_unc = dat.range_diff(dat.data[0], dat.data[1], 40, 5)
+        self.assertEqual(co.shape, (dat.cnum, 0))
+
+
+
+class TestStackingPrecision(unittest.TestCase):
+
+    def setUp(self):
+        self.dat = synthetic_apres(bnum=4, cnum=4, dtype=np.complex64)
+        self.dat.n_subbursts = 2
+        self.dat.header.n_attenuators = 2
+
+    def test_by_group(self):
+        for by in ['attenuator', 'setting', 'subburst']:
+            dat = synthetic_apres(bnum=4, cnum=4, dtype=np.complex64)
+            dat.n_subbursts = 2
+            dat.header.n_attenuators = 2
+            dat.stacking(by=by)
+            self.assertEqual(dat.data.dtype, np.complex64)
+            self.assertEqual(dat.cnum, 2)
+
+    def test_by_time(self):
+        self.dat.stacking(time_window=1. / 48.)
+        self.assertEqual(self.dat.data.dtype, np.complex64)
+        self.assertEqual(self.dat.bnum, 2)
+
+    def test_weighted(self):
+        # a group stack leaves uneven counts behind, so the next stack is weighted
+        self.dat.stacking(by='attenuator')
+        self.dat.stack_count[0, 0] = 3
+        expected = np.average(self.dat.data[0], axis=0, weights=[3, 2])
+        self.dat.stacking(num_chirps=self.dat.cnum)
+        self.assertEqual(self.dat.data.dtype, np.complex64)
+        self.assertTrue(np.allclose(self.dat.data[0, 0], expected, rtol=1.0e-5))
+
+        self.dat.stacking()
+        self.assertEqual(self.dat.data.dtype, np.complex64)
+
+    def test_double_precision(self):
+        dat = synthetic_apres(bnum=4, cnum=4)
+        dat.header.n_attenuators = 2
+        dat.stacking(by='attenuator')
+        dat.stacking(time_window=1. / 48.)
+        self.assertEqual(dat.data.dtype, np.complex128)
+
+
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        self.dat = synthetic_apres(dtype=np.complex64)
+        self.dat.header.n_attenuators = 2
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, 'lazy.h5')
+        self.dat.save(self.fn)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_phase_uncertainty(self):
+        lazy = ApresData(self.fn, lazy=True)
+        self.assertFalse(isinstance(lazy.data, np.ndarray))
+        pu_lazy, r_lazy = lazy.phase_uncertainty(rng=0, chunk_size=1)
+        pu, r = self.dat.phase_uncertainty(rng=0)
+        self.assertTrue(np.allclose(pu_lazy, pu, equal_nan=True))
+        self.assertTrue(np.allclose(r_lazy, r, equal_nan=True))
+
+    def test_range_diff_series(self):
+        lazy = ApresData(self.fn, lazy=True)
+        self.assertTrue(np.allclose(lazy.range_diff_series(20, 5)[2], self.dat.range_diff_series(20, 5)[2]))
+
+    def test_stacking(self):
+        lazy = ApresData(self.fn, lazy=True)
+        lazy.header.n_attenuators = 2
+        lazy.stacking(by='attenuator')
+        self.dat.stacking(by='attenuator')
+        self.assertEqual(lazy.data.dtype, np.complex64)
+        self.assertTrue(np.allclose(lazy.data, self.dat.data))
+
+    def test_ndarray_fallback(self):
+        lazy = ApresData(self.fn, lazy=True)
+        self.assertTrue(np.allclose(lazy.data.real, self.dat.data.real))
+        self.assertTrue(np.allclose(np.abs(lazy.data), np.abs(self.dat.data)))
+        self.assertTrue(np.allclose(lazy.data * 2, self.dat.data * 2))
+
+
+class TestMatlab(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, 'dat.mat')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_missing_range_flag(self):
+        dat = synthetic_apres()
+        dat.header.n_attenuators = 2
+        dat.save(self.fn)
+        # as saved before the range flag was added
+        mat = loadmat(self.fn)
+        flags = mat['flags']
+        mat['flags'] = {name: flags[name][0][0] for name in flags.dtype.names if name != 'range'}
+        savemat(self.fn, {key: val for key, val in mat.items() if not key.startswith('__')})
+
+        loaded = ApresData(self.fn)
+        self.assertEqual(loaded.flags.range, 0)
+        self.assertEqual(loaded.flags.stack, dat.flags.stack)
+        self.assertTrue(np.array_equal(loaded.data, dat.data))
+
+
+class TestBurstIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, 'raw.dat')
+        write_raw(self.fn, nburst=4, snum=100)
+        load_apres._BURST_INDEX_CACHE.clear()
+
+    def tearDown(self):
+        load_apres._BURST_INDEX_CACHE.clear()
+        self.tmpdir.cleanup()
+
+    def test_sidecar(self):
+        index = load_apres.load_burst_index(self.fn)
+        self.assertTrue(os.path.exists(self.fn + load_apres.BURST_INDEX_EXT))
+        self.assertEqual(len(index), 4)
+        self.assertTrue(np.array_equal(index, load_apres.build_burst_index(self.fn)))
+        load_apres._BURST_INDEX_CACHE.clear()
+        self.assertTrue(np.array_equal(load_apres.load_burst_index(self.fn), index))
+
+    def test_truncated_sidecar(self):
+        index = load_apres.load_burst_index(self.fn)
+        fn_index = self.fn + load_apres.BURST_INDEX_EXT
+        with open(fn_index, 'r+b') as fout:
+            fout.truncate(os.path.getsize(fn_index) // 2)
+        load_apres._BURST_INDEX_CACHE.clear()
+        self.assertTrue(np.array_equal(load_apres.load_burst_index(self.fn), index))
+        # and the sidecar has been rewritten
+        with np.load(fn_index) as sidecar_file:
+            self.assertTrue(np.array_equal(sidecar_file['index'], index))
+
+    def test_burst_from_index(self):
+        index = load_apres.load_burst_index(self.fn)
+        dat = load_apres.load_apres_single_file(self.fn, burst=3)
+        counts = np.fromfile(self.fn, dtype='<u2', count=dat.cnum * dat.snum,
+                             offset=int(index['data_offset'][2]))
+        self.assertTrue(np.array_equal(dat.data.ravel(), counts * 2.5 / 2**16))
+        with self.assertRaises(ValueError):
+            load_apres.load_apres_single_file(self.fn, burst=0)
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn_raw = os.path.join(self.tmpdir.name, 'raw.dat')
+        self.fn = os.path.join(self.tmpdir.name, 'archive.h5')
+        write_raw(self.fn_raw, nburst=4, snum=100)
+        self.bursts = list(load_apres.iter_bursts(self.fn_raw))
+        for burst in self.bursts:
+            burst.append_h5(self.fn, groupname='raw')
+
+    def tearDown(self):
+        load_apres._BURST_INDEX_CACHE.clear()
+        self.tmpdir.cleanup()
+
+    def test_read_group(self):
+        dat = ApresData(self.fn, groupname='raw')
+        self.assertEqual(dat.bnum, 4)
+        self.assertTrue(np.array_equal(dat.data, np.vstack([burst.data for burst in self.bursts])))
+        self.assertTrue(np.array_equal(dat.decday, np.hstack([burst.decday for burst in self.bursts])))
+        self.assertEqual(list(dat.time_stamp), [burst.time_stamp[0] for burst in self.bursts])
+
+    def test_time_range(self):
+        dat = load_apres.load_time_range(self.fn, self.bursts[1].time_stamp[0], self.bursts[3].time_stamp[0],
+                                         groupname='raw')
+        self.assertEqual(dat.bnum, 2)
+        self.assertTrue(np.array_equal(dat.data, np.vstack([burst.data for burst in self.bursts[1:3]])))
+        self.assertEqual(list(dat.time_stamp), [burst.time_stamp[0] for burst in self.bursts[1:3]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Distributed under terms of the GNU GPL3 license.
+
+"""
+Tests of reading raw ApRES bursts in batches for profile images
+"""
+import datetime
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from impdar.lib.ApresData.ApresProfile import _batches, _load_batch
+from impdar.lib.ApresData.load_apres import load_apres_single_file, load_burst_index
+
+HEADER = '\r\n'.join(['*** Burst Header ***',
+                      'Time stamp={time_stamp}',
+                      'RMB_Issue=2b',
+                      'VAB_Issue=C',
+                      'SW_Issue=101.0',
+                      'Venom_Issue=0',
+                      'Latitude=-70.1',
+                      'Longitude=-8.1',
+                      'Temp1={temp}',
+                      'Temp2=20',
+                      'BatteryVoltage=12.5',
+                      'Reg00="00000008"',
+                      'Reg01="000C0900"',
+                      'Reg02="0D1F41C8"',
+                      'Reg0B="6666666633333333"',
+                      'Reg0C="000053E3000053E3"',
+                      'Reg0D="186A186A"',
+                      'Reg0E="0CCCCCCD"',
+                      'N_ADC_SAMPLES={snum}',
+                      'NSubBursts=2',
+                      'Average={average}',
+                      'nAttenuators=2',
+                      'Attenuator1=30,20,0,0',
+                      'AFGain=-14,-4,0,0',
+                      'TxAnt=1,0,0,0,0,0,0,0',
+                      'RxAnt=1,0,0,0,0,0,0,0',
+                      'SamplingFreqMode=0',
+                      '*** End Header ***'])
+
+
+def write_raw(fn, nburst=5, snum=300, average=0, seed=0):
+    """A small rmb5 file whose headers differ in length, so the bursts are not evenly spaced."""
+    rng = np.random.default_rng(seed)
+    cnum = 1 if average else 4
+    t0 = datetime.datetime(2021, 12, 28, 21, 37, 52)
+    with open(fn, 'wb') as fout:
+        for burst in range(nburst):
+            time_stamp = (t0 + datetime.timedelta(minutes=15 * burst)).strftime('%Y-%m-%d %H:%M:%S')
+            fout.write(HEADER.format(time_stamp=time_stamp, temp=-5 * burst, snum=snum,
+                                     average=average).encode())
+            counts = rng.integers(0, 2**16, size=(cnum, snum))
+            fout.write(counts.astype('<u4' if average else '<u2').tobytes())
+
+
+class TestLoadBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_batches(self, fn, precision='float64'):
+        index = load_burst_index(fn, sidecar=False)
+        self.assertGreater(len(np.unique(index['data_offset'] % 2)), 1)
+        for batch in _batches(index, 3):
+            dat = _load_batch(fn, index, batch, precision)
+            singles = [load_apres_single_file(fn, burst=burst, precision=precision) for burst in batch]
+            self.assertEqual(dat.bnum, len(batch))
+            self.assertEqual(dat.data.dtype, singles[0].data.dtype)
+            self.assertTrue(np.array_equal(dat.data, np.stack([single.data for single in singles])))
+            self.assertTrue(np.array_equal(dat.decday, np.hstack([single.decday for single in singles])))
+            self.assertTrue(np.array_equal(dat.chirp_time, np.vstack([single.chirp_time for single in singles])))
+
+    def test_unaveraged(self):
+        fn = os.path.join(self.tmpdir.name, 'unaveraged.dat')
+        write_raw(fn)
+        self.check_batches(fn)
+        self.check_batches(fn, precision='float32')
+
+    def test_averaged(self):
+        fn = os.path.join(self.tmpdir.name, 'averaged.dat')
+        write_raw(fn, average=2)
+        self.check_batches(fn)
+
+
+if __name__ == '__main__':
+    unittest.main()
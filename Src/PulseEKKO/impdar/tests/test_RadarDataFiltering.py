@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Distributed under terms of the GNU GPL3 license.
+
+"""
+Tests of RadarData filtering on small synthetic data
+"""
+import contextlib
+import io
+import unittest
+
+import numpy as np
+from scipy.signal import butter, sosfiltfilt
+
+from impdar.tests.test_RadarDataProcessing import synthetic_radar
+
+
+def synthetic_profile(snum=20, tnum=3000, seed=5):
+    """Evenly spaced (2 m) traces with structure at all horizontal wavelengths."""
+    dat = synthetic_radar(snum=snum, tnum=tnum, seed=seed)
+    rng = np.random.default_rng(seed)
+    dat.data = np.cumsum(rng.normal(size=(snum, tnum)), axis=1) + 5. * dat.data
+    dat.flags.interp = [1, 2.]
+    dat.flags.elev = 0
+    return dat
+
+
+def horizontal_filter(name, args, **kwargs):
+    """The synthetic profile after one of the horizontal filters, without the progress output."""
+    dat = synthetic_profile()
+    with contextlib.redirect_stdout(io.StringIO()):
+        getattr(dat, name)(*args, **kwargs)
+    return dat.data
+
+
+class TestVerticalBandPass(unittest.TestCase):
+
+    def test_matches_sosfiltfilt(self):
+        dat = synthetic_radar(snum=200, tnum=30)
+        sos = butter(5, [2.0e6 / 5.0e7, 2.0e7 / 5.0e7], 'bandpass', output='sos')
+        expected = sosfiltfilt(sos, dat.data, axis=0, padlen=3 * (2 * sos.shape[0] + 1))
+        dat.vertical_band_pass(2., 20.)
+        self.assertTrue(np.allclose(dat.data, expected))
+
+    def test_workers(self):
+        serial = synthetic_radar(snum=200, tnum=30)
+        threaded = synthetic_radar(snum=200, tnum=30)
+        serial.vertical_band_pass(2., 20., chunk_size=7)
+        threaded.vertical_band_pass(2., 20., chunk_size=7, workers=4)
+        self.assertTrue(np.array_equal(serial.data, threaded.data))
+
+
+class TestHorizontalFilterFFT(unittest.TestCase):
+
+    def test_matches_filtfilt(self):
+        # The difference is the rounding error of the (b, a) form used by filtfilt
+        for name, args in [('highpass', (100, )), ('highpass', (1000, )), ('lowpass', (40, )),
+                           ('horizontal_band_pass', (20, 200))]:
+            expected = horizontal_filter(name, args)
+            scale = np.max(np.abs(expected))
+            for chunk_size in [None, 256]:
+                filtered = horizontal_filter(name, args, method='fft', chunk_size=chunk_size)
+                self.assertLess(np.max(np.abs(filtered - expected)) / scale, 1.0e-5, (name, args, chunk_size))
+
+    def test_band_pass_matches_sos(self):
+        # the narrow, low band is unstable in the (b, a) form, but not in the fft
+        for low, high in [(20, 200), (200, 3000)]:
+            sos = butter(5, [2. / int(high / 2.), 2. / int(low / 2.)], 'bandpass', output='sos')
+            expected = sosfiltfilt(sos, synthetic_profile().data, padlen=33)
+            scale = np.max(np.abs(expected))
+            for chunk_size in [None, 256]:
+                filtered = horizontal_filter('horizontal_band_pass', (low, high), method='fft',
+                                             chunk_size=chunk_size)
+                self.assertLess(np.max(np.abs(filtered - expected)) / scale, 1.0e-8, (low, high, chunk_size))
+
+
+if __name__ == '__main__':
+    unittest.main()
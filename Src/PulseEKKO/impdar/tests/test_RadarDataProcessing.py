@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Distributed under terms of the GNU GPL3 license.
+
+"""
+Tests of RadarData processing on small synthetic data
+"""
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.optimize import brentq
+
+from impdar.lib.RadarData import RadarData
+from impdar.lib.RadarData._RadarDataProcessing import moveout_rms_velocity
+from impdar.lib.permittivity_models import firn_permittivity
+
+
+def synthetic_radar(snum=60, tnum=40, dtype=np.float64, seed=0):
+    """A RadarData object with noise for data, a rough surface and an nmo depth."""
+    rng = np.random.default_rng(seed)
+    dat = RadarData(None)
+    dat.snum, dat.tnum = snum, tnum
+    dat.data = rng.normal(size=(snum, tnum)).astype(dtype)
+    dat.dt = 1.0e-8
+    dat.travel_time = np.arange(snum) * dat.dt * 1.0e6
+    dat.trig = 0
+    dat.elev = 10. * rng.random(tnum)
+    dat.nmo_depth = np.arange(snum) * dat.dt * 1.69e8 / 2.
+    return dat
+
+
+def baseline_restack(arr, traces):
+    """Mean of each full stack of traces, one stack at a time (as restack did originally)."""
+    arr = np.atleast_2d(arr)
+    tnum = arr.shape[1] // traces
+    return np.array([np.mean(arr[:, j * traces:(j + 1) * traces], axis=1) for j in range(tnum)]).transpose()
+
+
+class TestRestack(unittest.TestCase):
+
+    def setUp(self):
+        self.dat = synthetic_radar(tnum=41)
+        self.dat.dist = np.cumsum(np.random.default_rng(1).random(self.dat.tnum))
+        self.dat.decday = 738000. + np.arange(self.dat.tnum) / 86400.
+        self.dat.trace_int = np.full((self.dat.tnum, ), 0.5)
+
+    def test_mean(self):
+        data, dist, decday = self.dat.data.copy(), self.dat.dist.copy(), self.dat.decday.copy()
+        self.dat.restack(5)
+        self.assertEqual(self.dat.tnum, 8)
+        self.assertTrue(np.allclose(self.dat.data, baseline_restack(data, 5)))
+        self.assertTrue(np.allclose(self.dat.dist, baseline_restack(dist, 5)[0]))
+        self.assertTrue(np.allclose(self.dat.decday, baseline_restack(decday, 5)[0], rtol=0., atol=1.0e-9))
+        self.assertTrue(np.allclose(self.dat.trace_int, 2.5))
+        self.assertTrue(np.array_equal(self.dat.trace_num, np.arange(1, 9)))
+
+    def test_even_traces(self):
+        data = self.dat.data.copy()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.dat.restack(4)
+        self.assertTrue(np.allclose(self.dat.data, baseline_restack(data, 5)))
+
+    def test_median_tail_weights(self):
+        data = self.dat.data.copy()
+        median = synthetic_radar(tnum=41)
+        median.restack(5, method='median', keep_tail=True)
+        self.assertEqual(median.tnum, 9)
+        self.assertTrue(np.allclose(median.data[:, :8], np.median(data[:, :40].reshape((-1, 8, 5)), axis=2)))
+        self.assertTrue(np.allclose(median.data[:, 8], data[:, 40]))
+
+        weighted = synthetic_radar(tnum=41)
+        weights = np.random.default_rng(2).random(41)
+        weighted.restack(5, weights=weights)
+        expected = baseline_restack(data * weights, 5) / baseline_restack(weights, 5)
+        self.assertTrue(np.allclose(weighted.data, expected))
+
+
+class TestNMO(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn_rho = os.path.join(self.tmpdir.name, 'rho.csv')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_constant_profile(self):
+        # a uniform profile has to give the constant-velocity correction
+        depth = np.linspace(0., 100., 201)
+        np.savetxt(self.fn_rho, np.column_stack((depth, np.full(depth.shape, 917.))), delimiter=',')
+        uice = 3.0e8 / np.sqrt(np.real(firn_permittivity(np.array([917.])))[0])
+        const, profile = synthetic_radar(snum=300), synthetic_radar(snum=300)
+        const.nmo(10., uice=uice, const_sample=False)
+        profile.nmo(10., rho_profile=self.fn_rho, const_sample=False)
+        self.assertTrue(np.allclose(profile.travel_time, const.travel_time, rtol=1.0e-10))
+
+    def test_rms_velocity(self):
+        # against solving t = 2 sqrt(d^2 + ant_sep^2) / u_rms(d) for each sample
+        depth = np.linspace(0., 60., 601)
+        u = 2.3e8 - 0.6e8 * (1. - np.exp(-depth / 15.))
+        travel_time = np.linspace(0.1, 0.6, 25)
+        ant_sep = 5.
+
+        def u_rms(d):
+            above = depth <= d
+            return np.sqrt(np.mean(u[above]**2.))
+
+        expected = []
+        for t in travel_time:
+            d = brentq(lambda d: 2.0e6 * np.sqrt(d**2. + ant_sep**2.) / u_rms(d) - t, 0., depth[-1], xtol=1.0e-9)
+            expected.append(u_rms(d))
+        self.assertTrue(np.allclose(moveout_rms_velocity(travel_time, ant_sep, depth, u), expected, rtol=1.0e-3))
+
+
+class TestRangeGain(unittest.TestCase):
+
+    def test_per_trace_trig(self):
+        dat = synthetic_radar()
+        dat.trig = np.random.default_rng(1).integers(0, 20, dat.tnum).astype(float)
+        expected = dat.data.copy()
+        for i, trig in enumerate(dat.trig):
+            expected[int(trig) + 1:, i] *= dat.travel_time[int(trig) + 1:] * 0.1
+        dat.rangegain(0.1)
+        self.assertTrue(np.array_equal(dat.data, expected))
+
+    def test_scalar_trig(self):
+        dat = synthetic_radar()
+        dat.trig = np.int64(4)
+        expected = dat.data.copy()
+        expected[5:, :] *= np.atleast_2d(dat.travel_time[5:] * 0.1).transpose()
+        dat.rangegain(0.1)
+        self.assertTrue(np.array_equal(dat.data, expected))
+
+
+class TestElevCorrect(unittest.TestCase):
+
+    def expected(self, dat, v_avg=1.69e8):
+        elev_diffs = np.max(dat.elev) - dat.elev
+        dz_avg = dat.dt * (v_avg / 2.)
+        offsets = (elev_diffs // dz_avg).astype(int)
+        out = np.full((dat.snum + int(np.floor(np.max(elev_diffs) / dz_avg)), dat.tnum), np.nan)
+        for i, offset in enumerate(offsets):
+            out[offset:offset + dat.snum, i] = dat.data[:, i]
+        return out
+
+    def test_nan_fill(self):
+        dat = synthetic_radar()
+        expected = self.expected(dat)
+        dat.elev_correct()
+        self.assertEqual(dat.data.dtype, np.float64)
+        self.assertTrue(np.array_equal(dat.data, expected, equal_nan=True))
+
+    def test_runs_of_equal_shift(self):
+        dat = synthetic_radar()
+        dat.elev = np.repeat([3., 2.5, 2.5, 0., 1.], 8)
+        expected = self.expected(dat)
+        dat.elev_correct()
+        self.assertTrue(np.array_equal(dat.data, expected, equal_nan=True))
+
+    def test_masked_float32(self):
+        dat = synthetic_radar()
+        expected = self.expected(dat)
+        dat.elev_correct(dtype=np.float32, masked=True)
+        self.assertEqual(dat.data.dtype, np.float32)
+        self.assertTrue(np.array_equal(dat.data.mask, np.isnan(expected)))
+        self.assertTrue(np.array_equal(dat.data.filled(np.nan), expected.astype(np.float32), equal_nan=True))
+
+
+if __name__ == '__main__':
+    unittest.main()